@@ -1,11 +1,16 @@
+import codecs
 import sys
+import time
 from collections import Counter
 from datetime import datetime
-from time import sleep
 
 import common
 import consts
+import cron
 import db
+import lineage
+import logs
+import runs
 import schema
 import task_procs
 from common import AttrDict
@@ -27,7 +32,8 @@ def menu(arguments):
     else:
         try:
             if arguments['create']:
-                Task.create(**_task_create_kwargs(arguments))
+                with db.transaction():
+                    Task.create(**_task_create_kwargs(arguments)).updateNextDue()
 
             elif arguments['read']:
                 task_read(arguments)
@@ -47,7 +53,16 @@ def menu(arguments):
             elif arguments['run']:
                 task_run(arguments)
 
-        except NameError as exc:
+            elif arguments['runs']:
+                task_runs(arguments)
+
+            elif arguments['log']:
+                task_log(arguments)
+
+            elif arguments['stats']:
+                task_stats(arguments)
+
+        except (NameError, ValueError) as exc:
             print(PACKAGE_NAME, 'Error!', exc)
             sys.exit(1)
 
@@ -104,6 +119,8 @@ def _task_create_kwargs(arguments):
             command=result.command if result.command else '<inherit>',
             email='<inherit>',
             condition=result.condition if result.condition else '<inherit>',
+            timeout='<inherit>',
+            digest='<inherit>',
         ))
 
     result.update(_task_sched_kwargs(arguments))
@@ -116,37 +133,50 @@ def _task_sched_kwargs(arguments):
         if arguments['--' + sched]:
             return dict(schedule=sched)
 
+    if arguments['--cron']:
+        cron.parse(arguments['--cron']).next(datetime.now())  # raises ValueError if invalid, or never matching
+        return dict(schedule=arguments['--cron'])
+
     return dict()
 
 
+def _secs_value(value: str) -> str:
+    if value == lineage.INHERIT:
+        return value
+
+    secs = float(value)  # raises ValueError if invalid
+
+    if secs < 0:
+        raise ValueError('negative seconds: ' + value)
+
+    return str(secs)
+
+
 def _task_lineage_dicts(parent: str = '', task_filter=lambda task: True) -> [dict]:
     tasks = []
-    stack = [tasks]
+    included = [(-1, tasks, None)]  # [(level, subtasks, task dict)], nearest included ancestors
 
-    def _push_subtasks():
-        last_task = stack[-1][-1] if len(stack[-1]) else dict()
-        last_task['~subtasks'] = []
-        stack.append(last_task['~subtasks'])
+    def _close_subtasks():
+        _, subtasks, task = included.pop()
 
-    def _pop_subtasks():
-        stack.pop()
-        last_task = stack[-1][-1] if len(stack[-1]) else dict()
+        if subtasks:
+            task['~summary'] = _state_summary_dict(subtasks)
 
-        if '~subtasks' in last_task:
-            last_task['~summary'] = _state_summary_dict(last_task['~subtasks'])
+        else:
+            del task['~subtasks']
 
     for task, level in Task.walkIter(parent=parent):
-        while level > len(stack) - 1:
-            _push_subtasks()
-
-        while level < len(stack) - 1:
-            _pop_subtasks()
+        while included[-1][0] >= level:
+            _close_subtasks()
 
         if task_filter(task):
-            stack[-1] += [task.__dict__]
+            task_dict = task.__dict__
+            task_dict['~subtasks'] = []
+            included[-1][1].append(task_dict)
+            included.append((level, task_dict['~subtasks'], task_dict))
 
-    while 0 < len(stack) - 1:
-        _pop_subtasks()
+    while len(included) > 1:
+        _close_subtasks()
 
     if parent:
         parent_task = Task(name=parent).__dict__
@@ -231,8 +261,10 @@ def _task_list_table(arguments):
         col_names = 'name state schedule last'.split(' ')
 
     if arguments['--ancestor']:
-        tasks = filter(lambda rec: _holdings_filter(Task(record=rec), arguments), db.list_table('tasks'))
-        tasks = filter(lambda task: _decendant_filter(task, arguments['--ancestor']), tasks)
+        tasks_lineage = lineage.current()  # loaded once, no other scan of tasks
+        tasks = (schema.TableSchema(tasks_lineage.record(name))
+                 for name in sorted(tasks_lineage.descendants(arguments['--ancestor'])))
+        tasks = filter(lambda rec: _holdings_filter(Task(record=rec), arguments), tasks)
 
     else:
         where = dict(name=arguments['<name>']) if arguments['<name>'] else dict()
@@ -243,18 +275,6 @@ def _task_list_table(arguments):
     common.print_table([name.upper() for name in col_names], rows)
 
 
-def _decendant_filter(task: Task, ancestor: str) -> bool:
-    parent = task.parent
-
-    while parent != "":
-        if parent == ancestor:
-            return True
-
-        parent = db.read(table='tasks', name=parent).parent
-
-    return False
-
-
 def task_set(arguments):
     if arguments['schedule']:
         kwargs = _task_sched_kwargs(arguments)
@@ -271,6 +291,18 @@ def task_set(arguments):
     elif arguments['log']:
         kwargs = dict(log=arguments['<text>'])
 
+    elif arguments['priority']:
+        kwargs = dict(priority=int(arguments['<priority>']))  # higher starts first
+
+    elif arguments['timeout']:
+        kwargs = dict(timeout=_secs_value(arguments['<sec>']))
+
+    elif arguments['digest']:
+        kwargs = dict(digest=_secs_value(arguments['<sec>']))  # 0 to mail each notification
+
+    elif arguments['condition-ttl']:
+        kwargs = dict(condition_ttl=float(arguments['<sec>']))  # reuse condition result, 0 to evaluate per tick
+
     else:
         kwargs = dict(
             (field, arguments['<exe>'])
@@ -280,7 +312,12 @@ def task_set(arguments):
 
     assert kwargs, 'unexpected empty attrs to set for tasks'
 
-    db.update('tasks', name=arguments['<name>'], **kwargs)
+    with db.transaction():
+        db.update('tasks', name=arguments['<name>'], **kwargs)
+
+        if 'schedule' in kwargs or 'parent' in kwargs:
+            Task(arguments['<name>']).updateNextDue()
+
     arguments['--fields'] = 'name,' + ','.join(kwargs.keys())
     _task_list_table(arguments)
 
@@ -298,7 +335,11 @@ def task_abort(arguments):
         if yn != 'y':
             return
 
-    task.fail()
+    with db.transaction():
+        if not task.fail():
+            print(PACKAGE_NAME, 'Error! Task', task.name, 'changed state to', task.state, 'while aborting.')
+            sys.exit(1)
+
     _task_list_table(arguments)
 
 
@@ -313,7 +354,11 @@ def task_reset(arguments):
         print(PACKAGE_NAME, 'Error! Task', task.name, 'must be failed before reset.')
         sys.exit(1)
 
-    task.reset()
+    with db.transaction():
+        if not task.reset():
+            print(PACKAGE_NAME, 'Error! Task', task.name, 'changed state to', task.state, 'while resetting.')
+            sys.exit(1)
+
     _task_list_table(arguments)
 
 
@@ -324,19 +369,64 @@ def task_run(arguments):
         verbose(0, 'Warning! task', task.name, 'already running.')
         return
 
-    task_procs.start(task)
-    log = open(task.log)
+    if not task_procs.start(task):
+        verbose(0, 'Warning! task', task.name, 'started by other.')
+        return
+
+    served = [0.]  # time.monotonic() of the last serve, a Db write
 
-    while True:
-        where = log.tell()
-        line = log.readline()
+    def done() -> bool:  # served completed, and if terminated, killed; served on exit, else every FOLLOW_CHECK
+        if not task_procs.wait(0) and time.monotonic() - served[0] < logs.FOLLOW_CHECK:
+            return False
 
-        if not line:
-            if not task_procs.serve():
-                break
+        served[0] = time.monotonic()
+        return not task_procs.serve() and not task_procs.lingering()
 
-            sleep(1)
-            log.seek(where)
+    _write_chunks(logs.follow(task.log, task_procs.g_procs[task.name].log_start, done))  # this run's output only
 
-        else:
-            print(line.replace('\n', ' '))
+
+def task_runs(arguments):
+    records = _runs(arguments['<name>'])
+
+    if arguments['--YAML'] or arguments['--JSON']:
+        common.dump(records, toyaml=arguments['--YAML'], tojson=arguments['--JSON'], entry=dict)
+
+    else:
+        col_names = 'start duration returncode timed_out cpu_user cpu_sys max_rss'.split(' ')
+        common.print_table(['RUN'] + [name.upper() for name in col_names],
+                           ([str(number)] + [run[col] for col in col_names] for number, run in enumerate(records, 1)))
+
+
+def task_log(arguments):  # seeks straight to the run's output, in its log segment
+    records = _runs(arguments['<name>'])
+    number = int(arguments['--run'])
+
+    if not number or abs(number) > len(records):
+        raise ValueError('task {} has no run {}, of {} runs'.format(arguments['<name>'], number, len(records)))
+
+    run = records[number - 1 if number > 0 else number]
+
+    try:
+        _write_chunks(logs.read(run.log, int(run.log_start), int(run.log_end)))
+
+    except FileNotFoundError:
+        raise ValueError('log of task {} run {} rotated out: {}'.format(run.name, run.start, run.log))
+
+
+def _runs(name: str) -> [AttrDict]:  # oldest first, as numbered by task runs and task log --run
+    return sorted(db.list_table('runs', name=name), key=lambda run: run.start)
+
+
+def _write_chunks(chunks: iter):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')  # chars split across chunks
+
+    for chunk in chunks:
+        sys.stdout.write(decoder.decode(chunk))
+        sys.stdout.flush()
+
+
+def task_stats(arguments):  # durations & cpu in secs, max_rss in KB
+    col_names = 'name runs failed timed_out p50 p95 max cpu max_rss'.split(' ')
+    rows = ([stat.name] + ['{:g}'.format(round(stat[col], 3)) for col in col_names[1:]]
+            for stat in runs.stats(arguments['<name>'] or ''))
+    common.print_table([name.upper() for name in col_names], rows)
@@ -1,8 +1,10 @@
 import getpass
+import gzip
 import importlib.util
 import importlib.machinery
 import itertools
 import json
+import math
 import os
 import io
 import subprocess
@@ -152,5 +154,31 @@ def wait_until(predicate: Callable, timeout: timedelta, interval: int = 1):
         raise TimeoutError('timed-out after {}'.format(timeout))
 
 
+def percentile(values: [float], pct: float) -> float:  # nearest-rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def open_rotated(file_path: str):  # binary, else its .gz if compressed since, e.g. a rotated log segment
+    if not os.path.exists(file_path) and os.path.exists(file_path + '.gz'):
+        return gzip.open(file_path + '.gz', 'rb')  # seeks by decompressing forward, never from the end
+
+    return open(file_path, 'rb')
+
+
+def file_tail(file_path: str, size: int, end: int = None) -> str:  # last size bytes up to end, from a line start
+    with open_rotated(file_path) as f:  # seeking back from the end, never reading the whole file
+        if not isinstance(f, gzip.GzipFile):  # else up to end, required
+            end = f.seek(0, os.SEEK_END) if end is None else min(end, f.seek(0, os.SEEK_END))
+
+        start = f.seek(max(0, end - size - 1))  # with the preceding byte, telling if at a line start
+        data = f.read(end - start)
+
+    if start:
+        data = data.split(b'\n', 1)[1] if b'\n' in data else data[1:]
+
+    return data.decode(errors='replace')
+
+
 if __name__ == '__main__':
     m = load_module('autolite')
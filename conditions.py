@@ -0,0 +1,97 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
+from verbosity import verbose
+
+TASK_NAME_VAR = 'AUTOLITE_TASK_NAME'
+
+g_cache = dict()  # {key: (result, evaluated at, ttl)}, reused within a task's condition_ttl, then evicted
+g_lock = threading.Lock()
+g_config = None  # conditions settings, read once
+
+
+def evaluate(tasks: iter, fresh: bool = False) -> {str: bool}:  # {task name: condition met}, fresh ignores ttl
+    config = _config()
+    now = time.monotonic()
+    keys = dict()  # {task name: key}
+    commands = dict()  # {key: (command, task name)}, to evaluate
+    ttls = dict()  # {key: longest condition_ttl of its tasks}
+    hits = dict()  # {key: cached result}
+
+    for task in tasks:
+        shared = keys[task.name] = key(task)
+
+        if shared is None:
+            continue
+
+        ttl = float(task.condition_ttl or 0)
+        ttls[shared] = max(ttl, ttls.get(shared, 0))
+
+        with g_lock:
+            cached = g_cache.get(shared)
+
+        if cached and not fresh and now - cached[1] <= ttl:
+            verbose(2, 'condition:', shared[1], 'cached result:', cached[0])
+            hits[shared] = cached[0]
+
+        else:
+            commands.setdefault(shared, (shared[1], task.name))
+
+    if len(commands) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(commands), int(config.workers))) as pool:
+            results = dict(zip(commands, pool.map(lambda args: _run(*args, timeout=float(config.timeout)),
+                                                  commands.values())))
+
+    else:
+        results = dict((shared, _run(*args, timeout=float(config.timeout))) for shared, args in commands.items())
+
+    with g_lock:
+        g_cache.update((shared, (result, now, ttls[shared])) for shared, result in results.items())
+
+        for shared, (_, at, ttl) in list(g_cache.items()):  # stale, e.g. of ttl 0, unless reused by these tasks
+            if now - at > max(ttl, ttls.get(shared, 0)):
+                del g_cache[shared]
+
+    hits.update(results)
+    return dict((name, True if shared is None else hits[shared]) for name, shared in keys.items())
+
+
+def _config():
+    global g_config
+
+    if g_config is None:
+        g_config = settings.read().conditions
+
+    return g_config
+
+
+def key(task) -> tuple:  # tasks of equal keys share their condition's result, None if no condition
+    condition = task.inheritedAttr('condition')
+
+    if not condition:
+        return None
+
+    condition = str(condition)
+    return (task.name, condition) if TASK_NAME_VAR in condition else ('', condition)
+
+
+def _run(condition: str, name: str, timeout: float) -> bool:
+    proc = subprocess.Popen(condition, shell=True, start_new_session=True,
+                            env=dict(os.environ, **{TASK_NAME_VAR: name}))
+
+    try:
+        result = proc.wait(timeout or None) == 0
+
+    except subprocess.TimeoutExpired:
+        verbose(1, 'condition:', condition, 'timed out after', timeout, 'secs')
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        result = False
+
+    verbose(2, 'condition:', condition, 'result:', result)
+    return result
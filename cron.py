@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+FIELDS = [  # (name, min, max) per cron expression field
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day', 1, 31),
+    ('month', 1, 12),
+    ('weekday', 0, 7),  # 0 & 7 are sunday
+]
+
+NAMES = dict(
+    month=dict((name, i + 1) for i, name in enumerate('jan feb mar apr may jun jul aug sep oct nov dec'.split(' '))),
+    weekday=dict((name, i) for i, name in enumerate('sun mon tue wed thu fri sat'.split(' '))),
+)
+
+ALIASES = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+
+SEARCH_YEARS = 5  # bound for expressions that never match, e.g. Feb 30
+
+
+class Cron(object):
+
+    def __init__(self, expr: str):
+        self.expr = expr
+        fields = ALIASES.get(expr.strip(), expr).split()
+
+        if len(fields) != len(FIELDS):
+            raise ValueError('cron expression must have {} fields: {}'.format(len(FIELDS), expr))
+
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            _parse_field(field, *spec) for field, spec in zip(fields, FIELDS))
+        self._anyDay = fields[2] == '*' or fields[4] == '*'  # else day OR weekday, as cron does
+
+    def __repr__(self):
+        return self.expr
+
+    def next(self, after: datetime) -> datetime:  # first matching minute after the given time
+        dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        end = after + timedelta(days=366 * SEARCH_YEARS)
+
+        while dt < end:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+
+            elif not self._dayMatch(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+
+            else:
+                return dt
+
+        raise ValueError('cron expression never matches: ' + self.expr)
+
+    def _dayMatch(self, dt: datetime) -> bool:
+        day, weekday = dt.day in self.days, dt.isoweekday() % 7 in self.weekdays
+        return (day and weekday) if self._anyDay else (day or weekday)
+
+
+@lru_cache(maxsize=None)
+def parse(expr: str) -> Cron:
+    return Cron(expr)
+
+
+def _parse_field(field: str, name: str, low: int, high: int) -> frozenset:
+    values = set()
+
+    for part in field.lower().split(','):
+        span, _, step = part.partition('/')
+
+        if span == '*':
+            first, last = low, high
+
+        elif '-' in span:
+            first, last = (_field_value(value, name) for value in span.split('-', 1))
+
+        else:
+            first = _field_value(span, name)
+            last = high if step else first
+
+        step = _field_value(step, name) if step else 1
+
+        if not low <= first <= last <= high or step < 1:
+            raise ValueError('invalid cron {} field: {}'.format(name, field))
+
+        values.update(range(first, last + 1, step))
+
+    if name == 'weekday' and 7 in values:
+        values = (values - {7}) | {0}
+
+    return frozenset(values)
+
+
+def _field_value(value: str, name: str) -> int:
+    if value in NAMES.get(name, {}):
+        return NAMES[name][value]
+
+    try:
+        return int(value)
+
+    except ValueError:
+        raise ValueError('invalid cron {} value: {}'.format(name, value))
@@ -1,15 +1,24 @@
 import os
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
 from typing import Iterator
 
 import settings
 from common import AttrDict
-from schema import TABLE_SCHEMAS, TableSchema
+from schema import TABLE_SCHEMAS, TABLE_KEYS, TABLE_INDEXES, SCHEMA_VERSION, PYTYPES, TableSchema
 from verbosity import verbose, set_verbosity
 
 
-g_conn = None
+MAX_PARAMS = 999  # SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds
+
+g_local = threading.local()  # per-thread: conn, pid, depth, on_commit
 g_db_path = ''
+g_sqlite = AttrDict()  # sqlite settings of the connected Db
+g_forked_conns = []
+g_write_listeners = []  # [listener(table, op, records)], op: create | update | delete | reset
 g_table_columns = AttrDict()  # {tname: TableColumns()}
 
 
@@ -42,33 +51,98 @@ class TableColumns(object):
         return (col[index] for col in self._cols)
 
 
+JOURNAL_MODES = ['delete', 'truncate', 'persist', 'memory', 'wal', 'off']
+SYNCHRONOUS_LEVELS = ['off', 'normal', 'full', 'extra']
+
+
+def connection() -> sqlite3.Connection:
+    if getattr(g_local, 'pid', None) != os.getpid():  # never use, nor close, a connection inherited by fork
+        if getattr(g_local, 'conn', None) is not None:  # not of a new thread
+            g_forked_conns.append(g_local.conn)
+
+        g_local.conn, g_local.pid, g_local.depth = None, os.getpid(), 0
+
+    return g_local.conn
+
+
 def connect():
-    global g_conn
+    if connection() is None:
+        global g_db_path, g_sqlite
+        _settings = settings.read()
+        g_db_path = os.path.expanduser(_settings.db_path)
+        g_sqlite = _settings.sqlite
+        assert g_sqlite.journal_mode in JOURNAL_MODES, 'invalid sqlite journal_mode: ' + g_sqlite.journal_mode
+        assert g_sqlite.synchronous in SYNCHRONOUS_LEVELS, 'invalid sqlite synchronous: ' + g_sqlite.synchronous
 
-    if g_conn is None:
-        global g_db_path
-        g_db_path = os.path.expanduser(settings.read().db_path)
-        g_conn = sqlite3.connect(g_db_path)
-        verbose(2, 'connected to', g_db_path)
+        g_local.conn = sqlite3.connect(g_db_path, timeout=float(g_sqlite.busy_timeout))
+        execute('PRAGMA journal_mode=' + g_sqlite.journal_mode)
+        execute('PRAGMA synchronous=' + g_sqlite.synchronous)
+        verbose(2, 'connected to', g_db_path, 'with', dict(g_sqlite))
 
 
 def disconnect():
-    global g_conn
+    conn = connection()
 
-    if g_conn is not None:
-        g_conn.commit()
-        g_conn.close()
+    if conn is not None:
+        conn.commit()
+        conn.close()
         verbose(2, 'closed connection to:', g_db_path)
-        g_conn = None
+        g_local.conn = None
+        _written(None, 'reset')
+
+
+def execute(sql: str, params: tuple = ()) -> sqlite3.Cursor:
+    cur = connection().cursor()
+    _busy_retried(cur.execute, sql, params)
+    return cur
+
+
+def executemany(sql: str, params_seq: iter) -> sqlite3.Cursor:
+    cur = connection().cursor()
+    _busy_retried(cur.executemany, sql, list(params_seq))
+    return cur
+
+
+def _busy_retried(func, *args):  # on top of the connection's busy timeout
+    retries = int(g_sqlite.busy_retries)
+
+    for attempt in range(retries + 1):
+        try:
+            return func(*args)
+
+        except sqlite3.OperationalError as exc:
+            if attempt == retries or not str(exc).startswith(('database is locked', 'database is busy')):
+                raise
+
+            verbose(1, 'Db busy, retry', attempt + 1, 'of', retries, '-', exc)
+            time.sleep(float(g_sqlite.busy_backoff) * 2 ** attempt)
 
 
 def init(drop=False):
     connect()
 
+    if drop or schema_version() != SCHEMA_VERSION:
+        cur = execute('BEGIN IMMEDIATE')  # one migrating process, others wait & re-check
+
+        try:
+            if drop:
+                for tname in TABLE_SCHEMAS.keys():
+                    cur.execute('DROP TABLE IF EXISTS ' + tname)
+
+                cur.execute('DROP TABLE IF EXISTS schema_version')
+
+            _upgrade_schema(cur)
+
+        except Exception:
+            connection().rollback()
+            raise
+
+        connection().commit()
+
     for tname in TABLE_SCHEMAS.keys():
-        if drop or not load_table_info(tname):
-            _drop_create_table(tname)
-            load_table_info(tname)
+        load_table_info(tname)
+
+    _written(None, 'reset')
 
 
 def fini():
@@ -81,7 +155,7 @@ def fini():
 
 def load_table_info(tname):
     if tname not in g_table_columns:
-        cols = g_conn.cursor().execute('PRAGMA table_info("{}")'.format(tname)).fetchall()
+        cols = execute('PRAGMA table_info("{}")'.format(tname)).fetchall()
 
         if cols:
             g_table_columns[tname] = TableColumns(*cols)
@@ -93,38 +167,262 @@ def load_table_info(tname):
     return g_table_columns[tname]
 
 
-def _drop_create_table(tname):
-    cur = g_conn.cursor()
-    cur.execute('DROP TABLE IF EXISTS ' + tname)
-    cur.execute('CREATE TABLE {} ({})'.format(tname, str(TABLE_SCHEMAS[tname])))
+def schema_version() -> int:
+    cur = connection().cursor()
+
+    if not _table_exists(cur, 'schema_version'):
+        return 0
+
+    values = cur.execute('SELECT version FROM schema_version').fetchone()
+    return values[0] if values else 0
+
+
+def _upgrade_schema(cur):
+    version = schema_version()
+    cur.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+
+    if version == 0 and not any(_table_exists(cur, tname) for tname in TABLE_SCHEMAS.keys()):
+        for tname in TABLE_SCHEMAS.keys():
+            _create_table(cur, tname)
+
+        version = SCHEMA_VERSION
+
+    elif version > SCHEMA_VERSION:
+        raise RuntimeError('Db schema version {} is newer than supported {}'.format(version, SCHEMA_VERSION))
+
+    for migrate in MIGRATIONS[version:]:
+        migrate(cur)
+        verbose(1, 'migrated Db schema, version', version, '->', version + 1)
+        version += 1
+
+    for tname in TABLE_SCHEMAS.keys():
+        _create_indexes(cur, tname)
+
+    cur.execute('DELETE FROM schema_version')
+    cur.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+
+    for tname in TABLE_SCHEMAS.keys():
+        if tname in g_table_columns:
+            del g_table_columns[tname]
+
+
+def _table_exists(cur, tname) -> bool:
+    return bool(cur.execute('PRAGMA table_info("{}")'.format(tname)).fetchall())
+
+
+def _create_table(cur, tname):
+    cur.execute('CREATE TABLE {} ({}, PRIMARY KEY ({}))'.format(tname, str(TABLE_SCHEMAS[tname]), TABLE_KEYS[tname]))
     verbose(2, 'initialized table:', tname)
 
 
-def create(table, **kwargs):
-    _assert_not_existing(table, kwargs['name'])
+def _create_indexes(cur, tname):
+    for col in TABLE_INDEXES[tname]:
+        cur.execute('CREATE INDEX IF NOT EXISTS {t}_{c} ON {t} ({c})'.format(t=tname, c=col))
+
+
+def _migrate_keyed_tables(cur):  # rebuild unkeyed tables with primary key, last duplicate wins
+    for tname in TABLE_SCHEMAS.keys():
+        if not _table_exists(cur, tname):
+            _create_table(cur, tname)
+            continue
+
+        legacy = tname + '_v0'
+        cur.execute('ALTER TABLE {} RENAME TO {}'.format(tname, legacy))
+        _create_table(cur, tname)
+
+        legacy_cols = set(col[1] for col in cur.execute('PRAGMA table_info("{}")'.format(legacy)).fetchall())
+        cols = ','.join(col for col in TABLE_SCHEMAS[tname].keys() if col in legacy_cols)
+        cur.execute('INSERT OR REPLACE INTO {t} ({c}) SELECT {c} FROM {l} ORDER BY rowid'.format(
+            t=tname, c=cols, l=legacy))
+        cur.execute('DROP TABLE ' + legacy)
+
+
+def _migrate_new_columns(cur):  # add schema columns missing from existing tables, with type's empty value
+    for tname, table_schema in TABLE_SCHEMAS.items():
+        if not _table_exists(cur, tname):
+            _create_table(cur, tname)
+            continue
+
+        existing_cols = set(col[1] for col in cur.execute('PRAGMA table_info("{}")'.format(tname)).fetchall())
+
+        for col, col_type in table_schema.items():
+            if col not in existing_cols:
+                cur.execute('ALTER TABLE {} ADD COLUMN {} {} DEFAULT \'{}\''.format(
+                    tname, col, col_type, PYTYPES[col_type]()))
+                verbose(2, 'added column:', tname + '.' + col)
+
+
+MIGRATIONS = [  # MIGRATIONS[v] upgrades schema version v to v + 1
+    _migrate_keyed_tables,
+    _migrate_new_columns,  # tasks.next_due
+    _migrate_new_columns,  # tasks.priority
+    _migrate_new_columns,  # tasks.condition_ttl
+    _migrate_new_columns,  # tasks.timeout
+    _migrate_new_columns,  # runs table
+    _migrate_new_columns,  # tasks.digest
+]
+
+assert len(MIGRATIONS) == SCHEMA_VERSION, 'missing Db schema migrations'
+
+
+@contextmanager
+def transaction():  # group writes into one commit, nested transactions join the outermost
+    depth = getattr(g_local, 'depth', 0)
+
+    if not depth:
+        g_local.on_commit = []
+
+        if not connection().in_transaction:
+            execute('BEGIN IMMEDIATE')  # take the write lock upfront, never upgrade a read midway
+
+    g_local.depth = depth + 1
+
+    try:
+
+        yield
+
+    except BaseException:
+        g_local.depth = depth
+
+        if not depth:
+            connection().rollback()
+            g_local.on_commit = []
+            _written(None, 'reset')
+            verbose(2, 'rolled back transaction')
+
+        raise
+
+    g_local.depth = depth
+
+    if not depth:
+        connection().commit()
+        callbacks, g_local.on_commit = g_local.on_commit, []
+
+        for callback in callbacks:
+            callback()
+
+
+def in_transaction() -> bool:
+    return getattr(g_local, 'depth', 0) > 0
+
+
+def on_commit(callback):
+    if in_transaction():
+        g_local.on_commit.append(callback)
+
+    else:
+        callback()
+
+
+def _commit():
+    if not in_transaction():
+        connection().commit()
+
+
+def add_write_listener(listener):  # listener(table, op, records), called on this thread's writes
+    g_write_listeners.append(listener)
 
+
+def _written(table, op: str, records: [dict] = ()):
+    for listener in g_write_listeners:
+        listener(table, op, records)
+
+
+def data_version() -> int:  # changes with commits by other connections
+    return execute('PRAGMA data_version').fetchone()[0]
+
+
+def create(table, **kwargs):
     record = TABLE_SCHEMAS[table].new(**kwargs)
-    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table, *record.for_insert())
-    g_conn.cursor().execute(sql)
-    g_conn.commit()
+    cols, values = record.for_insert()
+
+    try:
+        execute(_insert_sql(table, cols), values)
+
+    except sqlite3.IntegrityError:
+        raise NameError('already exists in {}: {}'.format(table, kwargs['name']))
+
+    _written(table, 'create', [record])
+    _commit()
     verbose(1, 'created', table[:-1], repr(record))
     return record
 
 
+def create_many(table, records: [dict]) -> [TableSchema]:
+    created = [TABLE_SCHEMAS[table].new(**kwargs) for kwargs in records]
+
+    if created:
+        cols = created[0].for_insert()[0]
+
+        with transaction():
+            try:
+                executemany(_insert_sql(table, cols), (record.for_insert()[1] for record in created))
+
+            except sqlite3.IntegrityError:
+                raise NameError('already exists in {}: {}'.format(
+                    table, ', '.join(record.name for record in created if existing(table, record.name))))
+
+            _written(table, 'create', created)
+
+        verbose(1, 'created', len(created), table)
+
+    return created
+
+
 def update(table, **kwargs):
-    _assert_existing(table, kwargs['name'])
+    record = TABLE_SCHEMAS[table].new(**kwargs)
+    cols, values = record.for_update(**kwargs)
+    cur = execute(_update_sql(table, cols), values + (kwargs['name'],))
+
+    if not cur.rowcount:
+        raise NameError('missing from {}: {}'.format(table, kwargs['name']))
 
+    _written(table, 'update', [kwargs])
+    _commit()
+    verbose(2, 'updated', table[:-1], repr(record))
+
+
+def update_if(table, expected: dict, **kwargs) -> bool:  # compare-and-set: only while expected values hold
     record = TABLE_SCHEMAS[table].new(**kwargs)
-    sql = 'UPDATE {} SET {} WHERE name=\'{}\''.format(table, record.for_update(**kwargs), kwargs['name'])
-    g_conn.cursor().execute(sql)
-    g_conn.commit()
+    cols, values = record.for_update(**kwargs)
+    expected_cols, expected_values = TABLE_SCHEMAS[table].new(**expected).for_where(**expected)
+    cur = execute(_update_sql(table, cols, expected_cols), values + (kwargs['name'],) + expected_values)
+
+    if not cur.rowcount:
+        _assert_all_existing(table, [kwargs['name']])
+        verbose(2, 'not updated', table[:-1], kwargs['name'] + ', expected', expected)
+        return False
+
+    _written(table, 'update', [kwargs])
+    _commit()
     verbose(2, 'updated', table[:-1], repr(record))
+    return True
+
+
+def update_many(table, records: [dict]):
+    records = list(records)
+    groups = dict()  # {cols: [values]}
+
+    for kwargs in records:
+        cols, values = TABLE_SCHEMAS[table].new(**kwargs).for_update(**kwargs)
+        groups.setdefault(cols, []).append(values + (kwargs['name'],))
+
+    with transaction():
+        for cols, values_list in groups.items():
+            cur = executemany(_update_sql(table, cols), values_list)
+
+            if cur.rowcount != len(values_list):
+                _assert_all_existing(table, (values[-1] for values in values_list))
+
+        _written(table, 'update', records)
+
+    verbose(2, 'updated', len(records), table)
 
 
 def read(table, name) -> TableSchema:
-    sql = 'SELECT * FROM {} WHERE name=\'{}\''.format(table, name)
-    verbose(2, 'reading:', sql)
-    values = g_conn.cursor().execute(sql).fetchone()
+    sql = _select_sql(table, ('name',))
+    verbose(2, 'reading:', sql, name)
+    values = execute(sql, (name,)).fetchone()
 
     if not values:
         raise NameError('missing from {}: {}'.format(table, name))
@@ -134,46 +432,157 @@ def read(table, name) -> TableSchema:
     return record
 
 
+def read_many(table, names: iter) -> {str: TableSchema}:  # existing records by name, in few queries
+    names = list(names)
+    records = dict()
+
+    for i in range(0, len(names), MAX_PARAMS):
+        chunk = names[i:i + MAX_PARAMS]
+
+        for values in execute(_select_in_sql(table, len(chunk)), tuple(chunk)).fetchall():
+            record = _new_schema(table, values)
+            records[record.name] = record
+
+    verbose(2, 'read', len(records), 'of', len(names), table)
+    return records
+
+
 def existing(table, name) -> bool:
-    sql = 'SELECT 1 FROM {} WHERE name=\'{}\' LIMIT 1'.format(table, name)
-    values = g_conn.cursor().execute(sql).fetchone()
+    values = execute(_existing_sql(table), (name,)).fetchone()
     exists = values is not None and len(values) > 0
     verbose(2, name, 'does' if exists else 'does not', 'exist')
     return exists
 
 
-def _assert_existing(table, name):
-    if not existing(table, name=name):
-        raise NameError('missing from {}: {}'.format(table, name))
-
+def _assert_all_existing(table, names: iter):
+    missing = [name for name in names if not existing(table, name)]
 
-def _assert_not_existing(table, name):
-    if existing(table, name=name):
-        raise NameError('already exists in {}: {}'.format(table, name))
+    if missing:
+        raise NameError('missing from {}: {}'.format(table, ', '.join(missing)))
 
 
 def delete(table, name):
-    _assert_existing(table, name)
+    cur = execute(_delete_sql(table), (name,))
 
-    sql = 'DELETE FROM {} WHERE name=\'{}\''.format(table, name)
-    g_conn.cursor().execute(sql)
-    g_conn.commit()
+    if not cur.rowcount:
+        raise NameError('missing from {}: {}'.format(table, name))
+
+    _written(table, 'delete', [dict(name=name)])
+    _commit()
     verbose(1, 'deleted', table[:-1] + ':', name)
 
 
+def delete_many(table, names: [str]):
+    names = list(names)
+
+    with transaction():
+        _assert_all_existing(table, names)
+        executemany(_delete_sql(table), ((name,) for name in names))
+        _written(table, 'delete', [dict(name=name) for name in names])
+
+    verbose(1, 'deleted', len(names), table)
+
+
 def list_table(table, **where) -> Iterator:
     return (_new_schema(table, row) for row in rows(table, **where))
 
 
+def list_until(table, col: str, until: str, **where) -> Iterator:  # where col <= until, ordered by col
+    cols, values = TABLE_SCHEMAS[table].new(**where).for_where(**where) if where else ((), ())
+    sql = _select_until_sql(table, col, cols)
+    verbose(3, sql, values, until)
+    return (_new_schema(table, row) for row in execute(sql, values + (until,)).fetchall())
+
+
+def min_after(table, col: str, after: str, **where) -> str:  # least col value > after, None if none
+    cols, values = TABLE_SCHEMAS[table].new(**where).for_where(**where) if where else ((), ())
+    return execute(_min_after_sql(table, col, cols), values + (after,)).fetchone()[0]
+
+
+def delete_before(table, col: str, before: str, **where) -> int:  # where col < before, return count deleted
+    cols, values = TABLE_SCHEMAS[table].new(**where).for_where(**where) if where else ((), ())
+    cur = execute(_delete_before_sql(table, col, cols), values + (before,))
+    _written(table, 'delete')
+    _commit()
+    return cur.rowcount
+
+
+def delete_beyond(table, col: str, keep: int, **where) -> int:  # all but the keep greatest col, return count deleted
+    cols, values = TABLE_SCHEMAS[table].new(**where).for_where(**where) if where else ((), ())
+    cur = execute(_delete_beyond_sql(table, col, cols), values + values + (keep,))
+    _written(table, 'delete')
+    _commit()
+    return cur.rowcount
+
+
 def rows(table, sep='', **where) -> iter:
+    cols, values = TABLE_SCHEMAS[table].new(**where).for_where(**where) if where else ((), ())
+    sql = _select_sql(table, cols)
+    verbose(3, sql, values)
+    return iter(sep.join(row) if sep else row
+                for row in execute(sql, values).fetchall())
+
+
+# Fixed SQL text per table & column set, so sqlite3's statement cache hits
+
+
+@lru_cache(maxsize=None)
+def _insert_sql(table: str, cols: tuple) -> str:
+    return 'INSERT INTO {} ({}) VALUES ({})'.format(table, ','.join(cols), ','.join('?' * len(cols)))
+
+
+@lru_cache(maxsize=None)
+def _update_sql(table: str, cols: tuple, expected_cols: tuple = ()) -> str:
+    return 'UPDATE {} SET {} WHERE name=?{}'.format(
+        table, ','.join(col + '=?' for col in cols), ''.join(' AND {}=?'.format(col) for col in expected_cols))
+
+
+@lru_cache(maxsize=None)
+def _select_sql(table: str, cols: tuple) -> str:
     sql = 'SELECT * FROM ' + table
 
-    if where:
-        sql += ' WHERE ' + TABLE_SCHEMAS[table].new(**where).for_where(**where)
+    if cols:
+        sql += ' WHERE ' + ' AND '.join(col + '=?' for col in cols)
 
-    verbose(3, sql)
-    return iter(sep.join(row) if sep else row
-                for row in g_conn.cursor().execute(sql).fetchall())
+    return sql
+
+
+@lru_cache(maxsize=None)
+def _select_in_sql(table: str, count: int) -> str:
+    return 'SELECT * FROM {} WHERE name IN ({})'.format(table, ','.join('?' * count))
+
+
+@lru_cache(maxsize=None)
+def _select_until_sql(table: str, col: str, cols: tuple) -> str:
+    return '{} {} {}<=? ORDER BY {}'.format(_select_sql(table, cols), 'AND' if cols else 'WHERE', col, col)
+
+
+@lru_cache(maxsize=None)
+def _min_after_sql(table: str, col: str, cols: tuple) -> str:
+    return 'SELECT MIN({c}) FROM {t} WHERE {w}{c}>?'.format(
+        c=col, t=table, w=''.join(c + '=? AND ' for c in cols))
+
+
+@lru_cache(maxsize=None)
+def _delete_before_sql(table: str, col: str, cols: tuple) -> str:
+    return 'DELETE FROM {t} WHERE {w}{c}<?'.format(t=table, c=col, w=''.join(c + '=? AND ' for c in cols))
+
+
+@lru_cache(maxsize=None)
+def _delete_beyond_sql(table: str, col: str, cols: tuple) -> str:
+    where = ''.join(c + '=? AND ' for c in cols)
+    return 'DELETE FROM {t} WHERE {w}{c}<(SELECT {c} FROM {t} WHERE {w}1 ORDER BY {c} DESC LIMIT 1 OFFSET ?-1)'.format(
+        t=table, c=col, w=where)
+
+
+@lru_cache(maxsize=None)
+def _existing_sql(table: str) -> str:
+    return 'SELECT 1 FROM {} WHERE name=? LIMIT 1'.format(table)
+
+
+@lru_cache(maxsize=None)
+def _delete_sql(table: str) -> str:
+    return 'DELETE FROM {} WHERE name=?'.format(table)
 
 
 def _new_schema(table, values) -> TableSchema:
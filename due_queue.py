@@ -0,0 +1,127 @@
+import heapq
+import threading
+from datetime import datetime, timedelta
+
+import db
+from task import Task
+from verbosity import verbose
+
+HORIZON = timedelta(hours=1)  # tasks due within it are queued, reloaded once half of it passed
+
+g_local = threading.local()  # per-thread: queue, version, conn, loaded (at)
+
+
+class DueQueue(object):
+
+    def __init__(self, tasks: iter):
+        self._heap = []  # [(due, name)], stale entries skipped on pop
+        self._dues = dict()  # {name: due}, the valid entry per pending task
+        self._dirty = set()  # names written since, due recomputed on next pop
+
+        for task in tasks:
+            self.push(task)
+
+    def __len__(self) -> int:
+        return len(self._dues)
+
+    def push(self, task: Task):
+        due = self._taskDue(task)
+
+        if due is None:
+            self._dues.pop(task.name, None)
+
+        else:
+            self.snooze(task.name, due)
+
+    def snooze(self, name: str, due: datetime):
+        self._dues[name] = due
+        self._dirty.discard(name)
+        heapq.heappush(self._heap, (due, name))
+
+    def retry(self, name: str, at: datetime):  # not started: due by its writes since, e.g. last, yet not before at
+        if name not in self._dirty:  # held back, e.g. by running slots
+            self.snooze(name, at)
+            return
+
+        self._dirty.discard(name)
+
+        try:
+            due = self._taskDue(Task(name=name))
+
+        except NameError:  # deleted
+            return
+
+        if due is not None:
+            self.snooze(name, max(due, at))
+
+    def touch(self, names: iter):
+        self._dirty.update(names)
+
+    def popDue(self, now: datetime) -> [str]:  # names due by now, in due order
+        self._refresh()
+        names = []
+
+        while self._heap and self._heap[0][0] <= now:
+            due, name = heapq.heappop(self._heap)
+
+            if self._dues.get(name) == due:
+                del self._dues[name]
+                names.append(name)
+
+        return names
+
+    def nextDue(self) -> datetime:
+        self._refresh()
+
+        while self._heap and self._dues.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+        return self._heap[0][0] if self._heap else None
+
+    def _refresh(self):
+        while self._dirty:
+            name = self._dirty.pop()
+
+            try:
+                self.push(Task(name=name))
+
+            except NameError:  # deleted
+                self._dues.pop(name, None)
+
+    @staticmethod
+    def _taskDue(task: Task) -> datetime:  # None if not to be scheduled
+        if not task.pending or not task.command:
+            return None
+
+        if task.continuous:
+            return datetime.min
+
+        return task.nextDue
+
+
+def current() -> DueQueue:  # loaded once, patched by own writes, reloaded on commits by other connections
+    version = db.data_version()
+    now = datetime.now()
+
+    if getattr(g_local, 'queue', None) is None or g_local.version != version \
+            or g_local.conn is not db.connection() or now - g_local.loaded >= HORIZON / 2:
+        g_local.queue = DueQueue(Task.listDue(now + HORIZON))  # by the indexed next_due, not all pending tasks
+        g_local.version, g_local.conn, g_local.loaded = version, db.connection(), now
+        verbose(2, 'loaded due queue of', len(g_local.queue), 'tasks, data version', version)
+
+    return g_local.queue
+
+
+def invalidate():  # reloaded by the next current()
+    g_local.queue = None
+
+
+def _on_write(table, op: str, records: [dict]):
+    if op == 'reset':
+        g_local.queue = None
+
+    elif table == 'tasks' and getattr(g_local, 'queue', None) is not None:
+        g_local.queue.touch(record['name'] for record in records)
+
+
+db.add_write_listener(_on_write)
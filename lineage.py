@@ -0,0 +1,114 @@
+import threading
+
+import db
+import schema
+from verbosity import verbose
+
+INHERIT = '<inherit>'
+
+g_local = threading.local()  # per-thread: lineage, version, conn
+
+
+class Lineage(object):
+
+    def __init__(self, records: iter):
+        self._records = dict((record.name, record) for record in records)
+        self._resolved = dict()  # {name: TableSchema}, memo of resolved records
+        self._children = None  # {parent: [name]}, adjacency index built on demand
+        self._descendants = dict()  # {ancestor: frozenset(name)}, closure memo
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._records
+
+    def record(self, name: str) -> schema.TableSchema:
+        try:
+            return self._records[name]
+
+        except KeyError:
+            raise NameError('missing from tasks: {}'.format(name))
+
+    def children(self, parent: str) -> [str]:
+        if self._children is None:
+            self._children = dict()
+
+            for record in self._records.values():
+                self._children.setdefault(record.parent, []).append(record.name)
+
+        return self._children.get(parent, [])
+
+    def descendants(self, ancestor: str) -> frozenset:
+        if ancestor not in self._descendants:
+            result = set()
+            stack = list(self.children(ancestor))
+
+            while stack:
+                name = stack.pop()
+
+                if name not in result and name != ancestor:
+                    result.add(name)
+                    stack += self.children(name)
+
+            self._descendants[ancestor] = frozenset(result)
+
+        return self._descendants[ancestor]
+
+    def resolved(self, name: str) -> schema.TableSchema:  # record with every <inherit> replaced from ancestry
+        if name not in self._resolved:
+            self._resolved[name] = schema.TableSchema(
+                (attr, self.resolvedAttr(name, attr)) for attr in self.record(name).keys())
+
+        return self._resolved[name]
+
+    def resolvedAttr(self, name: str, attr: str) -> str:
+        return self.record(self.resolvedFrom(name, attr))[attr]
+
+    def resolvedFrom(self, name: str, attr: str) -> str:  # name of the ancestor-or-self defining attr
+        record = self.record(name)
+        descendants = set()
+
+        while record[attr] == INHERIT:
+            assert record.parent, 'missing parent for <inherit>'
+            assert record.name not in descendants, 'cyclic inheritance at: ' + record.name
+            descendants.add(record.name)
+            record = self.record(record.parent)
+
+        return record.name
+
+    def patch(self, op: str, records: [dict]):
+        self._resolved = dict()
+        self._children = None
+        self._descendants = dict()
+
+        for kwargs in records:
+            if op == 'delete':
+                self._records.pop(kwargs['name'], None)
+
+            elif op == 'create':
+                self._records[kwargs['name']] = schema.TableSchema(kwargs)
+
+            elif kwargs['name'] in self._records:
+                updated = schema.TABLE_SCHEMAS.tasks.new(**kwargs)
+                self._records[kwargs['name']].update(dict((k, updated[k]) for k in kwargs.keys() if k in updated))
+
+
+def current() -> Lineage:  # loaded once, patched by own writes, reloaded on commits by other connections
+    version = db.data_version()
+
+    if getattr(g_local, 'lineage', None) is None \
+            or g_local.version != version or g_local.conn is not db.connection():
+        g_local.lineage = Lineage(db.list_table('tasks'))
+        g_local.version, g_local.conn = version, db.connection()
+        verbose(3, 'loaded tasks lineage, data version', version)
+
+    return g_local.lineage
+
+
+def _on_write(table, op: str, records: [dict]):
+    if op == 'reset':
+        g_local.lineage = None
+
+    elif table == 'tasks' and getattr(g_local, 'lineage', None) is not None:
+        g_local.lineage.patch(op, records)
+
+
+db.add_write_listener(_on_write)
@@ -0,0 +1,153 @@
+import ctypes
+import glob
+import gzip
+import os
+import select
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import common
+import settings
+from verbosity import verbose
+
+STAMP = '%Y%m%d-%H%M%S.%f'  # segment file names, by creation time
+READ_CHUNK = 64 * 1024
+FOLLOW_CHECK = 1.  # secs between checks if following is done, while no bytes arrive
+FOLLOW_POLL = 0.1  # secs between reads, where inotify is unavailable
+IN_MODIFY, IN_CLOSE_WRITE = 0x2, 0x8
+
+g_compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='logs')  # pending work completed on exit
+g_config = None  # logs settings, read once
+
+
+def segment(task_dir: str) -> str:  # the log segment for a task's next run, rotating the current one if due
+    os.makedirs(task_dir, exist_ok=True)
+    segments = _segments(task_dir, '*.log')
+
+    if segments and not _rotation_due(segments[-1]):
+        return segments[-1]
+
+    _prune(task_dir, keep=len(segments))
+
+    for rotated in segments:  # also those left uncompressed by an exit while compressing
+        g_compressor.submit(_compress, rotated)
+
+    return os.path.join(task_dir, datetime.now().strftime(STAMP) + '.log')
+
+
+def read(log_path: str, start: int, end: int) -> iter:  # chunks of the byte range, of the segment even if compressed
+    with common.open_rotated(log_path) as log:
+        log.seek(start)
+
+        for chunk in iter(lambda: log.read(max(0, min(READ_CHUNK, end - log.tell()))), b''):
+            yield chunk
+
+
+def follow(log_path: str, offset: int = 0, done=lambda: False) -> iter:  # new bytes as written, from offset
+    watch = _watch(log_path)  # woken by writes, instead of polling
+
+    try:
+        with open(log_path, 'rb') as log:
+            log.seek(offset)
+
+            while True:
+                finished = done()  # before reading, so the bytes written until done are drained
+
+                for chunk in iter(lambda: log.read(READ_CHUNK), b''):
+                    yield chunk
+
+                if finished:
+                    return
+
+                _wait(watch)
+
+    finally:
+        if watch is not None:
+            os.close(watch)
+
+
+def _watch(log_path: str) -> int:  # inotify fd of writes to log, None where unavailable
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+    except (OSError, AttributeError):  # not linux
+        return None
+
+    if fd < 0:
+        return None
+
+    if libc.inotify_add_watch(fd, os.fsencode(log_path), IN_MODIFY | IN_CLOSE_WRITE) < 0:
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def _wait(watch: int):
+    if watch is None:
+        time.sleep(FOLLOW_POLL)
+
+    elif select.select([watch], [], [], FOLLOW_CHECK)[0]:
+        os.read(watch, 64 * 1024)  # drain events, bytes are read from the log
+
+
+def _rotation_due(log_path: str) -> bool:  # over max size, or max age
+    config = _config()
+    size = os.path.getsize(log_path)
+    age = datetime.now() - _stamp(log_path)
+
+    if not size:
+        return False
+
+    return size >= float(config.max_size_mb) * 2 ** 20 or \
+        bool(config.max_age_days) and age.total_seconds() >= float(config.max_age_days) * 86400
+
+
+def _compress(log_path: str):
+    try:
+        with open(log_path, 'rb') as log, gzip.open(log_path + '.gz.tmp', 'wb') as compressed:
+            for chunk in iter(lambda: log.read(READ_CHUNK), b''):
+                compressed.write(chunk)
+
+        os.replace(log_path + '.gz.tmp', log_path + '.gz')
+        os.remove(log_path)
+        verbose(2, 'compressed log segment', log_path)
+
+    except FileNotFoundError:  # compressed already
+        pass
+
+    except OSError as exc:
+        verbose(0, 'Warning! log segment', log_path, 'not compressed:', str(exc))
+
+
+def _prune(task_dir: str, keep: int):  # compressed segments beyond max_segments, oldest first
+    config = _config()
+    compressed = _segments(task_dir, '*.log.gz')
+    excess = len(compressed) + keep + 1 - int(config.max_segments)  # counting the new segment, about to be created
+
+    for log_path in compressed[:max(0, excess)]:
+        os.remove(log_path)
+        verbose(2, 'removed log segment', log_path)
+
+
+def _segments(task_dir: str, pattern: str) -> [str]:  # oldest first, ignoring other files, e.g. foreign logs
+    return sorted(path for path in glob.glob(os.path.join(task_dir, pattern)) if _stamp(path) is not None)
+
+
+def _stamp(log_path: str) -> datetime:  # creation time by the segment's name, None if not named by STAMP
+    try:
+        return datetime.strptime(os.path.basename(log_path).split('.log')[0], STAMP)
+
+    except ValueError:
+        return None
+
+
+def _config():
+    global g_config
+
+    if g_config is None:
+        g_config = settings.read().logs
+
+    return g_config
@@ -1,8 +1,12 @@
+import base64
 import os
+import re
 import smtplib
+from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+import common
 from verbosity import verbose
 
 HTML_TEMPLATE = '''
@@ -17,6 +21,9 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
+SMTP_TIMEOUT = 10.  # secs to connect, or wait for a reply, before giving up on the server
+ATTACH_CHUNK = 57 * 1024  # bytes of an attachment read & base64 encoded at once, into whole 76 chars lines
+
 
 class Email(object):
 
@@ -24,15 +31,21 @@ class Email(object):
                  smtp_server='smtp.gmail.com',
                  smtp_port=587,
                  smtp_username='',
-                 smtp_password=''):
+                 smtp_password='',
+                 starttls=True,
+                 timeout=SMTP_TIMEOUT):
+
+        self.smtp = smtplib.SMTP(smtp_server, smtp_port, timeout=timeout)  # bounding connect & each reply
+
+        if starttls:
+            self.smtp.starttls()
 
-        self.smtp = smtplib.SMTP(smtp_server, smtp_port)
-        self.smtp.starttls()
         self.username, self.password = smtp_username, smtp_password
         self.smtp.login(self.username, self.password)
 
     def send(self, content: str, recipients: list,
-             subject: str = '', html_head: str = '', file_paths: list = None, email_from=''):
+             subject: str = '', html_head: str = '', file_paths: list = None, email_from='', attach_tail: int = 0,
+             attach_end: int = None):
         assert content, 'missing content'
         assert recipients, 'missing recipients'
 
@@ -51,33 +64,78 @@ class Email(object):
             msg = MIMEMultipart()
             msg.attach(tmpmsg)
 
-            for filename in file_paths:
-                f = open(os.path.expanduser(filename))
-                attachment = MIMEText(f.read(), _subtype='octet-stream')
-                attachment.add_header('Content-Disposition', 'attachment', filename=filename)
-                msg.attach(attachment)
-
         msg['Subject'] = subject
         msg['To'] = ', '.join(recipients)
         msg['From'] = email_from
 
-        self.smtp.sendmail(email_from, list(recipients), msg.as_string())
+        if file_paths:
+            self._sendStreamed(email_from, list(recipients), msg, file_paths, attach_tail, attach_end)
+
+        else:
+            self.smtp.sendmail(email_from, list(recipients), msg.as_string())
 
         verbose(1, 'Mail sent to {}: "{}"'.format(recipients, subject))
 
-    def __del__(self):
-        if hasattr(self, 'smpt'):
-            try:
-                self.smtp.quit()
+    def _sendStreamed(self, email_from: str, recipients: list, msg: MIMEMultipart, file_paths: list, tail: int,
+                      end: int):
+        # attachments are read, encoded & sent in chunks, never whole in memory
+        head = msg.as_string()
+        closing = '--{}--'.format(msg.get_boundary())
+
+        self.smtp.ehlo_or_helo_if_needed()
+        self._expect(self.smtp.mail(email_from), [250], smtplib.SMTPSenderRefused, email_from)
+        refused = dict((recipient, reply) for recipient in recipients
+                       for reply in [self.smtp.rcpt(recipient)] if reply[0] not in [250, 251])
+
+        if len(refused) == len(recipients):
+            self.smtp.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        self._expect(self.smtp.docmd('data'), [354], smtplib.SMTPDataError)
+        self._sendData(head[:head.rindex(closing)])
+
+        for file_path in file_paths:
+            attachment = MIMEBase('application', 'octet-stream')
+            attachment['Content-Transfer-Encoding'] = 'base64'
+            attachment.add_header('Content-Disposition', 'attachment', filename=os.path.basename(file_path))
+            self._sendData('--{}\n{}\n'.format(
+                msg.get_boundary(), ''.join('{}: {}\n'.format(k, v) for k, v in attachment.items())))
+
+            for lines in _base64_chunks(file_path, tail, end):
+                self.smtp.send(lines)
 
-            except smtplib.SMTPServerDisconnected:
-                pass
+        self._sendData(closing + '\n')
+        self.smtp.send(b'.\r\n')  # end of data
+        self._expect(self.smtp.getreply(), [250], smtplib.SMTPDataError)
+
+    def _sendData(self, text: str):  # CRLF line ends, leading periods doubled
+        self.smtp.send(re.sub(r'(?m)^\.', '..', re.sub(r'\r?\n', '\r\n', text)).encode('ascii'))
+
+    def _expect(self, reply: tuple, codes: list, error: type, *args):
+        if reply[0] not in codes:
+            self.smtp.rset()
+            raise error(*(reply + args))
+
+    def close(self):
+        try:
+            self.smtp.quit()
+
+        except (smtplib.SMTPException, OSError):  # already dropped
+            self.smtp.close()
+
+    def __del__(self):
+        if hasattr(self, 'smtp'):
+            self.close()
 
 
 class FakeEmail(object):
 
+    def close(self):
+        pass
+
     def send(self, content: str, recipients: list,
-             subject: str = '', html_head: str = '', file_paths: list = None, email_from=''):
+             subject: str = '', html_head: str = '', file_paths: list = None, email_from='', attach_tail: int = 0,
+             attach_end: int = None):
         print('from:', email_from)
         print('to:', recipients)
         print('subject:', subject)
@@ -90,6 +148,20 @@ class FakeEmail(object):
             print('file paths:', file_paths)
 
 
+def _base64_chunks(file_path: str, tail: int = 0, end: int = None) -> iter:  # whole, or last tail bytes up to end
+    with common.open_rotated(os.path.expanduser(file_path)) as f:  # end required, if compressed
+        end = f.seek(0, os.SEEK_END) if end is None else end
+
+        if tail:
+            f.seek(max(0, end - tail))
+
+        else:
+            f.seek(0)
+
+        for chunk in iter(lambda: f.read(max(0, min(ATTACH_CHUNK, end - f.tell()))), b''):
+            yield base64.encodebytes(chunk).replace(b'\n', b'\r\n')
+
+
 if __name__ == '__main__':
     username = 'avital.yahel'
     email = Email(
@@ -0,0 +1,243 @@
+import atexit
+import html
+import os
+import queue
+import smtplib
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import common
+import mail
+import settings
+from common import AttrDict
+from verbosity import verbose
+
+FLUSH = None  # queued by flush(), sending pending digests
+EXIT_FLUSH = 5.  # secs an exiting process waits for pending mails, then drops them
+
+g_queue = queue.Queue()  # notifications, drained by the sender thread
+g_sender = None
+g_client = None  # of the sender thread, connected once and reused across mails
+g_config = None  # email settings, read once
+g_digests = dict()  # {recipient: Digest}, of the sender thread
+g_events = dict()  # {(recipient, task): event}, last posted
+g_transitions = dict()  # {(recipient, task, previous event): event}, last following it, for suppressing repeats
+
+
+class Digest(object):  # notifications to a recipient, aggregated over a window
+
+    def __init__(self, due: float):
+        self.due = due  # time.monotonic()
+        self.since = datetime.now()
+        self.counts = Counter()  # {event: count}
+        self.repeats = Counter()  # {(task, event): count}
+        self.failures = []  # [(subject, content)], listed in full
+
+    def add(self, notification: AttrDict):
+        self.counts[notification.event] += 1
+
+        if notification.event == 'failed':
+            self.failures.append((notification.subject, notification.content))
+
+        else:
+            self.repeats[(notification.task, notification.event)] += 1
+
+    def subject(self) -> str:
+        return 'autolite: {} notifications, {} failed'.format(sum(self.counts.values()), self.counts['failed'])
+
+    def content(self) -> str:
+        lines = ['since {}:'.format(self.since.strftime('%Y-%m-%d %H:%M:%S'))]
+        lines += ['{}: {}'.format(event or 'notified', count) for event, count in sorted(self.counts.items())]
+        lines += [''] + ['task {} {} x {}'.format(task, event, count)
+                         for (task, event), count in sorted(self.repeats.items())]
+
+        for subject, content in self.failures:
+            lines += ['', subject, content]
+
+        return '\n'.join(lines)
+
+
+def post(recipients: [str], subject: str, content: str, task: str = '', event: str = '', digest: float = None,
+         log: str = ''):
+    global g_sender  # never blocks on mail; digest secs None for the settings' digest, 0 to mail each
+
+    g_queue.put(AttrDict(recipients=recipients, subject=subject, content=content, task=task, event=event,
+                         digest=digest, log=log, log_end=_log_size(log)))  # log excerpted up to its size by now
+
+    if g_sender is None or not g_sender.is_alive():
+        g_sender = threading.Thread(target=_send_loop, name='notifier', daemon=True)
+        g_sender.start()
+
+
+def aggregating() -> bool:  # by the settings' digest, or repeats suppression, of this process's notifications
+    config = _config()
+    return bool(float(config.digest)) or bool(config.suppress_repeats)
+
+
+def flush(timeout: float = 30.) -> bool:  # send pending digests, wait for all to be sent or given up
+    if g_sender is None:
+        return True
+
+    g_queue.put(FLUSH)
+
+    with g_queue.all_tasks_done:
+        return g_queue.all_tasks_done.wait_for(lambda: not g_queue.unfinished_tasks, timeout)
+
+
+def _send_loop():
+    while True:
+        due = min((digest.due for digest in g_digests.values()), default=None)
+
+        try:
+            notification = g_queue.get(timeout=None if due is None else max(0., due - time.monotonic()))
+
+        except queue.Empty:  # a digest is due
+            _send_digests(time.monotonic())
+            continue
+
+        try:
+            if notification is FLUSH:
+                _send_digests()
+
+            else:
+                _route(notification)
+
+        finally:
+            g_queue.task_done()
+
+
+def _route(notification: AttrDict):  # mail now, or add to digests; suppressing repeated events if configured
+    config = _config()
+    window = float(config.digest if notification.digest is None else notification.digest)
+    recipients = []
+
+    if notification.log_end and config.log_tail:
+        notification.content += _log_excerpt(notification.log, notification.log_end, int(float(config.log_tail) * 1024))
+
+    for recipient in notification.recipients:
+        key = (recipient, notification.task)  # repeated as the previous event, or following it as last time (cycles)
+        transition = key + (g_events.get(key),)
+        repeated = notification.event and notification.event in [transition[-1], g_transitions.get(transition)]
+        g_events[key] = g_transitions[transition] = notification.event
+
+        if window:
+            if recipient not in g_digests:
+                g_digests[recipient] = Digest(time.monotonic() + window)
+
+            g_digests[recipient].add(notification)
+
+        elif repeated and config.suppress_repeats:
+            verbose(2, 'suppressed repeated notification to', recipient + ':', notification.subject)
+
+        else:
+            recipients.append(recipient)
+
+    if recipients and notification.log_end and config.log_attach:
+        _mail(recipients, notification.subject, notification.content,
+              file_paths=[notification.log], attach_tail=int(float(config.log_attach) * 1024),
+              attach_end=notification.log_end)  # as excerpted, up to the log size when posted
+
+    elif recipients:
+        _mail(recipients, notification.subject, notification.content)
+
+
+def _log_size(log: str) -> int:
+    try:
+        return os.path.getsize(log) if log else 0
+
+    except OSError:  # log gone
+        return 0
+
+
+def _log_excerpt(log: str, end: int, size: int) -> str:
+    try:
+        return '\n\nlog tail of {}:\n{}'.format(log, html.escape(common.file_tail(log, size, end)))
+
+    except OSError as exc:
+        return '\n\nlog {} unreadable: {}'.format(log, exc)
+
+
+def _send_digests(now: float = None):  # due by now, or all
+    for recipient, digest in list(g_digests.items()):
+        if now is None or digest.due <= now:
+            del g_digests[recipient]
+            _mail([recipient], digest.subject(), digest.content())
+
+
+def _mail(recipients: [str], subject: str, content: str, **attachments):
+    try:
+        _send(recipients, subject, content, **attachments)
+
+    except Exception as exc:
+        verbose(0, 'Warning! mail to', recipients, 'dropped:', str(exc))
+
+
+def _send(recipients: [str], subject: str, content: str, **attachments):  # reconnecting & retrying, exponential backoff
+    global g_client
+
+    config = _config()
+
+    for attempt in range(int(config.retries) + 1):
+        try:
+            if g_client is None:
+                g_client = _new_client(config)
+
+            g_client.send(recipients=recipients, subject=subject, content=content, **attachments)
+            return
+
+        except (smtplib.SMTPException, OSError) as exc:
+            if not _retryable(exc):
+                raise
+
+            _drop_client()
+
+            if attempt == int(config.retries):
+                raise
+
+            delay = float(config.backoff) * 2 ** attempt
+            verbose(1, 'mail to', recipients, 'failed:', str(exc) + ', retrying in', delay, 'secs...')
+            time.sleep(delay)
+
+
+def _new_client(config):
+    if any(not config[key] for key in ['server', 'port', 'username', 'password']):
+        return mail.FakeEmail()  # notifying to stdout
+
+    client = mail.Email(
+        smtp_server=config.server,
+        smtp_port=config.port,
+        smtp_username=config.username,
+        smtp_password=config.password,
+        starttls=config.starttls,
+    )
+    verbose(2, 'connected to mail server', config.server, config.port)
+    return client
+
+
+def _drop_client():
+    global g_client
+
+    if g_client is not None:
+        g_client.close()
+        g_client = None
+
+
+def _retryable(exc: Exception) -> bool:  # dropped or transient, not a permanent (5xx) rejection
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return False
+
+    return not isinstance(exc, smtplib.SMTPResponseException) or exc.smtp_code < 500
+
+
+def _config():
+    global g_config
+
+    if g_config is None:
+        g_config = settings.read().email
+
+    return g_config
+
+
+atexit.register(flush, EXIT_FLUSH)
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+import common
+import db
+import schema
+import settings
+from common import AttrDict
+from verbosity import verbose
+
+g_config = None  # runs settings, read once
+
+
+def compact(names: iter):  # retention: drop runs older than retention_days, and beyond max_per_task per task
+    config = _config()
+
+    if config.retention_days:
+        before = str(datetime.now() - timedelta(days=float(config.retention_days)))
+        verbose(2, 'compacted', db.delete_before('runs', 'start', before), 'runs before', before)
+
+    if config.max_per_task:
+        for name in set(names):
+            db.delete_beyond('runs', 'start', int(config.max_per_task), name=name)
+
+
+def stats(name: str = '') -> [AttrDict]:  # per task: runs, failures, timeouts, duration percentiles & usage peaks
+    where = dict(name=name) if name else dict()
+    by_task = dict()
+
+    for run in db.list_table('runs', **where):  # record values read as text
+        by_task.setdefault(run.name, []).append(AttrDict(
+            (col, (float if col_type == 'REAL' else int)(run[col] or 0))
+            for col, col_type in schema.TABLE_SCHEMAS.runs.items() if col_type in ['INT', 'REAL']))
+
+    return [AttrDict(
+        name=task_name,
+        runs=len(task_runs),
+        failed=sum(1 for run in task_runs if run.returncode),
+        timed_out=sum(1 for run in task_runs if run.timed_out),
+        p50=common.percentile([run.duration for run in task_runs], 50),
+        p95=common.percentile([run.duration for run in task_runs], 95),
+        max=max(run.duration for run in task_runs),
+        cpu=max(run.cpu_user + run.cpu_sys for run in task_runs),
+        max_rss=max(run.max_rss for run in task_runs),
+    ) for task_name, task_runs in sorted(by_task.items())]
+
+
+def _config():
+    global g_config
+
+    if g_config is None:
+        g_config = settings.read().runs
+
+    return g_config
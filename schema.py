@@ -16,19 +16,18 @@ class TableSchema(AttrDict):
         result.update(dict((k, _empty(v)) for k, v in kwargs.items() if k in result))
         return result
 
-    def for_insert(self):
-        cols, vals = zip(*[(k, _quoted(v)) for k, v in self.items()])
-        return ','.join(cols), ','.join(vals)
+    def for_insert(self) -> (tuple, tuple):  # columns, values
+        return tuple(self.keys()), tuple(self.values())
 
-    def for_update(self, **kwargs):
-        return ','.join('='.join([k, _quoted(v)]) for k, v in self.items() if v or k in kwargs)
+    def for_update(self, **kwargs) -> (tuple, tuple):  # columns, values
+        return self._columns_values(**kwargs)
 
-    def for_where(self, **kwargs):
-        return ' AND '.join('{}={}'.format(k, _quoted(v)) for k, v in self.items() if v or k in kwargs)
+    def for_where(self, **kwargs) -> (tuple, tuple):  # columns, values
+        return self._columns_values(**kwargs)
 
-
-def _quoted(val):
-    return '\'{}\''.format(val) if isinstance(val, str) else _empty(val)
+    def _columns_values(self, **kwargs) -> (tuple, tuple):
+        pairs = [(k, v) for k, v in self.items() if v or k in kwargs]
+        return tuple(zip(*pairs)) if pairs else ((), ())
 
 
 def _empty(val):
@@ -56,6 +55,11 @@ TABLE_SCHEMAS = AttrDict(
         email='TEXT',
         log='TEXT',
         last='TEXT',
+        next_due='TEXT',
+        priority='INT',
+        condition_ttl='REAL',
+        timeout='TEXT',  # secs, or <inherit>
+        digest='TEXT',  # secs of notifications aggregation, or <inherit>; empty for email settings' digest
     ),
     systems=TableSchema(
         name='TEXT',
@@ -67,6 +71,34 @@ TABLE_SCHEMAS = AttrDict(
         user='TEXT',
         comment='TEXT',
     ),
+    runs=TableSchema(  # run history, appended by the runner
+        name='TEXT',  # of the task
+        start='TEXT',
+        end='TEXT',
+        duration='REAL',  # secs
+        returncode='INT',  # negative signal number if killed
+        timed_out='INT',
+        log='TEXT',
+        log_start='INT',  # offsets of the run's output in log
+        log_end='INT',
+        cpu_user='REAL',  # secs, of the task's shell & descendants it waited for
+        cpu_sys='REAL',
+        max_rss='INT',  # KB
+    ),
+)
+
+TABLE_KEYS = AttrDict(
+    tasks='name',
+    systems='name',
+    runs='name, start',
+)
+
+TABLE_INDEXES = AttrDict(
+    tasks=['state', 'parent', 'next_due'],
+    systems=[],
+    runs=['start'],
 )
 
+SCHEMA_VERSION = 7
+
 SCHEDULES = ['daily', 'hourly', 'continuous', 'never']
@@ -0,0 +1,54 @@
+import json
+import os
+import subprocess
+import sys
+
+from verbosity import verbose
+
+RC_FILES = ['~/.bashrc', '~/.bash_profile']  # the first existing is sourced
+
+SOURCE_RC = '''
+if [ -e ~/.bashrc ]
+then
+    . ~/.bashrc
+elif [ -e ~/.bash_profile ]
+then
+    . ~/.bash_profile
+fi
+'''
+
+MARKER = '<autolite-env>'  # rc files may print to stdout as well
+
+g_snapshot = None  # (rc files stamp, env)
+
+
+def snapshot() -> dict:  # env after sourcing the rc files, captured again once they change
+    global g_snapshot
+
+    stamp = _rc_stamp()
+
+    if g_snapshot is None or g_snapshot[0] != stamp:
+        g_snapshot = stamp, _capture()
+        verbose(2, 'captured shell env of', len(g_snapshot[1]), 'variables, rc files:', stamp)
+
+    return g_snapshot[1]
+
+
+def _rc_stamp() -> tuple:
+    stamp = []
+
+    for rc_file in RC_FILES:
+        try:
+            stat = os.stat(os.path.expanduser(rc_file))
+            stamp.append((rc_file, stat.st_mtime_ns, stat.st_size))
+
+        except FileNotFoundError:
+            pass
+
+    return tuple(stamp)
+
+
+def _capture() -> dict:
+    dump = '"{}" -c "import json, os; print(\'{}\' + json.dumps(dict(os.environ)))"'.format(sys.executable, MARKER)
+    output = subprocess.check_output(SOURCE_RC + dump, shell=True, universal_newlines=True)
+    return json.loads(output.rsplit(MARKER, 1)[1])
@@ -0,0 +1,43 @@
+from collections import Counter
+
+import settings
+from common import AttrDict
+from task import Task
+
+UNLIMITED = 0
+
+
+class Slots(object):  # running task counts against limits: overall, per parent, per resource capacity
+
+    def __init__(self, limits: AttrDict, running: iter):
+        self._limits = limits  # running, parent, resource (default capacity), capacities; UNLIMITED (0) by default
+        self._taken = Counter()
+
+        for task in running:
+            self.take(task)
+
+    def admits(self, task: Task) -> bool:
+        return all(self._taken[key] < limit for key, limit in self._keyLimits(task) if limit != UNLIMITED)
+
+    def take(self, task: Task):
+        self._taken.update(key for key, _ in self._keyLimits(task))
+
+    def _keyLimits(self, task: Task) -> [(tuple, int)]:
+        key_limits = [(('running',), self._limits.running)]
+
+        if task.parent:
+            key_limits.append((('parent', task.parent), self._limits.parent))
+
+        key_limits += [(('resource', resource), self._limits.capacities.get(resource, self._limits.resource))
+                       for resource in task.resourceSet]
+        return key_limits
+
+
+def limits(running: int = UNLIMITED, parent: int = UNLIMITED, resource: int = UNLIMITED,
+           capacities: dict = None) -> AttrDict:
+    return AttrDict(running=running, parent=parent, resource=resource, capacities=AttrDict(capacities or {}))
+
+
+def settings_limits() -> AttrDict:  # resource capacities as declared in settings
+    resources = settings.read().resources
+    return limits(resource=resources.capacity, capacities=resources.capacities)
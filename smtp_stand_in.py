@@ -0,0 +1,61 @@
+import socketserver
+import threading
+
+
+class SmtpStandIn(socketserver.ThreadingTCPServer):  # local SMTP server, for tests & benchmarks: no TLS, any login
+    daemon_threads = True
+
+    def __init__(self, drop_after: int = 0):
+        super(SmtpStandIn, self).__init__(('127.0.0.1', 0), _SmtpStandInHandler)
+        self.drop_after = drop_after  # close each connection after that many messages, 0 for never
+        self.connections = 0
+        self.messages = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _SmtpStandInHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.connections += 1
+        received = 0
+        self._reply('220 stand-in')
+
+        for line in iter(self.rfile.readline, b''):
+            verb = line.decode().split(' ')[0].strip().upper()
+
+            if verb == 'EHLO':
+                self._reply('250-stand-in', '250 AUTH PLAIN')
+
+            elif verb == 'AUTH':
+                self._reply('235 accepted')
+
+            elif verb == 'DATA':
+                self._reply('354 end with .')
+                self.server.messages.append(b''.join(iter(self._dataLine, None)).decode())
+                self._reply('250 queued')
+                received += 1
+
+                if received == self.server.drop_after:
+                    return
+
+            elif verb == 'QUIT':
+                self._reply('221 bye')
+                return
+
+            else:  # HELO, MAIL, RCPT, RSET, NOOP
+                self._reply('250 ok')
+
+    def _dataLine(self) -> bytes:  # None at end of data
+        line = self.rfile.readline()
+        return None if line in [b'.\r\n', b''] else line
+
+    def _reply(self, *lines):
+        self.wfile.write(''.join(line + '\r\n' for line in lines).encode())
@@ -1,84 +1,59 @@
-import os
-from contextlib import contextmanager
+from functools import lru_cache
+from typing import Iterator
 from datetime import datetime, timedelta
 
 import yaml
 
+import conditions
+import cron
 import db
-import mail
-import settings
+import lineage
+import notifier
+import schema
 from entity import Entity
 from verbosity import verbose
 
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+NEVER_DUE = str(datetime.max)
 
 
 class Task(Entity):
     _tableName = 'tasks'
 
-    _walkParents = []
-
     @classmethod
-    def walkIter(cls, **kwargs):  # yield task, level
-        for task in cls.list(**kwargs):
-            if task.name in cls._walkParents:
-                verbose(2, task.name, 'already in parents', cls._walkParents, ', skipping.')
-                continue
+    def walkIter(cls, parent: str = ''):  # yield task, level; depth-first over the loaded lineage
+        tasks_lineage = lineage.current()
+        walked = {parent}
+        stack = [(name, 0) for name in reversed(tasks_lineage.children(parent))]
 
-            yield task, len(cls._walkParents)
+        while stack:
+            name, level = stack.pop()
 
-            _kwargs = dict((k, v) for k, v in kwargs.items() if k not in ['name', 'parent'])
+            if name in walked:
+                verbose(2, name, 'already walked (cyclic parents), skipping.')
+                continue
 
-            with cls.walkParentsContext(parent=task.name):
-                for subtask in cls.walkIter(parent=task.name, **_kwargs):
-                    yield subtask
+            walked.add(name)
+            yield cls(record=schema.TableSchema(tasks_lineage.record(name))), level
+            stack += [(child, level + 1) for child in reversed(tasks_lineage.children(name))]
 
     @classmethod
-    @contextmanager
-    def walkParentsContext(cls, parent: str):
-        cls._walkParents.append(parent)
+    def listDue(cls, until: datetime) -> Iterator:  # pending tasks by the indexed next_due, soonest first
+        return (cls(record=db_record) for db_record in db.list_until('tasks', 'next_due', str(until), state='pending'))
 
-        yield
-
-        del cls._walkParents[-1]
+    @classmethod
+    def nextDueAfter(cls, after: datetime) -> datetime:  # soonest next_due of pending tasks, None if none
+        next_due = db.min_after('tasks', 'next_due', str(after), state='pending')
+        return None if next_due is None or next_due == NEVER_DUE else datetime.fromisoformat(next_due)
 
     def inheritedAttr(self, attr: str) -> object:
-        db_record = self._db_record
-
-        while getattr(db_record, attr) == '<inherit>':
-            assert db_record.parent, 'missing parent for <inherit>'
-            db_record = db.read('tasks', db_record.parent)
-
-        return getattr(db_record, attr)
-
-    @property
-    def mailClient(self) -> mail.Email:
-        if not hasattr(self, '_mailClient'):
-            email_settings = settings.read().email
-
-            if any(not value for value in email_settings.values()):
-                self._mailClient = mail.FakeEmail()
-
-            else:
-                try:
-                    self._mailClient = mail.Email(
-                        smtp_server=email_settings.server,
-                        smtp_port=email_settings.port,
-                        smtp_username=email_settings.username,
-                        smtp_password=email_settings.password,
-                    )
+        value = getattr(self._db_record, attr)
 
-                except Exception as exc:
-                    verbose(0, 'Warning! mail client returned with error:', str(exc),
-                            email_settings,
-                            type(email_settings.server),
-                            type(email_settings.port),
-                            type(email_settings.username),
-                            type(email_settings.password),
-                            '\nNotifying to stdout.')
-                    self._mailClient = mail.FakeEmail()
+        if value != lineage.INHERIT:
+            return value
 
-        return self._mailClient
+        assert self._db_record.parent, 'missing parent for <inherit>'
+        return lineage.current().resolvedAttr(self._db_record.parent, attr)
 
     @property
     def continuous(self) -> bool:
@@ -96,6 +71,11 @@ class Task(Entity):
     def never(self) -> bool:
         return self.inheritedAttr('schedule') == 'never'
 
+    @property
+    def cronSchedule(self) -> cron.Cron:  # None for the named schedules
+        schedule = self.inheritedAttr('schedule')
+        return cron.parse(schedule) if schedule and schedule not in schema.SCHEDULES else None
+
     @property
     def once(self) -> bool:
         return self._db_record.last.find('<once>') > -1
@@ -108,20 +88,43 @@ class Task(Entity):
         if self.continuous:
             return True
 
+        due = self.nextDue
+        return due is not None and due <= datetime.now()
+
+    @property
+    def nextDue(self) -> datetime:  # when ready by hourly | daily | cron schedule, None otherwise
+        return self._nextDueAfter(self._db_record.last)
+
+    def _nextDueAfter(self, last: str) -> datetime:
+        cron_schedule = self.cronSchedule
+
+        if not cron_schedule and not self.hourly and not self.daily:
+            return None
+
+        try:
+            last = datetime.fromisoformat(last.replace('<once>', ''))
+
+        except ValueError:
+            return datetime.min
+
+        if cron_schedule:
+            return cron_schedule.next(last)
+
         if self.hourly:
-            now = datetime.now()
-            now_modulu_hour = now - timedelta(minutes=now.minute, seconds=now.second, microseconds=now.microsecond)
-            return str(now_modulu_hour) > self._db_record.last
+            return last.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
 
-        if self.daily:
-            return str(datetime.now().date()) > self._db_record.last
+        return datetime.combine(last.date(), datetime.min.time()) + timedelta(days=1)
+
+    def _nextDueValue(self, last: str) -> str:  # for the next_due column, ordered as text
+        if self.continuous:
+            return str(datetime.min)
+
+        due = self._nextDueAfter(last)
+        return NEVER_DUE if due is None else str(due)
 
     @property
     def condition(self) -> bool:
-        condition = self.inheritedAttr('condition')
-        result = not condition or not os.system('export AUTOLITE_TASK_NAME="{}" ; '.format(self.name) + str(condition))
-        verbose(2, 'condition:', condition, 'result:', result)
-        return result
+        return conditions.evaluate([self])[self.name]
 
     @property
     def pending(self) -> bool:
@@ -139,64 +142,95 @@ class Task(Entity):
     def lastDT(self) -> datetime:
         return datetime.strptime(self._db_record.last, DATETIME_FORMAT)
 
-    def expired(self, timeout: int) -> bool:
-        return (datetime.now() - self.lastDT).total_seconds() > timeout
+    @property
+    def timeoutSecs(self) -> float:  # 0 for none of its own, nor inherited
+        return float(self.inheritedAttr('timeout') or 0)
+
+    @property
+    def digestSecs(self) -> float:  # None for the email settings' digest
+        digest = self.inheritedAttr('digest')
+        return float(digest) if digest else None
+
+    @property
+    def resourceSet(self) -> frozenset:
+        return resource_set(self.resources)
 
     def holdingAny(self, resources: str) -> bool:
-        return bool(self.resources and resources and (set(self.resources.split(' ')) & set(resources.split(' '))))
-
-    def start(self, log: str = ''):
-        with self.notifyStateChangeContext():
-            self._setLast(str(datetime.now()))
-            self._db_record.state = 'running'
-            self._db_record.log = log
-            db.update('tasks', name=self.name, state=self._db_record.state, last=self._db_record.last,
-                      log=self._db_record.log)
-
-    def fail(self):
-        with self.notifyStateChangeContext():
-            self._db_record.state = 'failed'
-            db.update('tasks', name=self.name, state=self._db_record.state)
-
-    def reset(self):
-        with self.notifyStateChangeContext():
-            self._db_record.state = 'pending'
-            db.update('tasks', name=self.name, state=self._db_record.state, last=self._db_record.last)
-
-    def skip(self):
-        with self.notifyStateChangeContext():
-            self._setLast('')
-            self._db_record.state = 'pending'
-            db.update('tasks', name=self.name, state=self._db_record.state, last=self._db_record.last)
+        return bool(self.resourceSet & resource_set(resources))
+
+    def start(self, log: str = '') -> bool:
+        return self._transit('running', last=self._lastValue(str(datetime.now())), log=log)
+
+    def fail(self) -> bool:
+        return self._transit('failed')
+
+    def reset(self) -> bool:
+        return self._transit('pending')
+
+    def skip(self) -> bool:
+        return self._transit('pending', last=self._lastValue(''))
 
     def updateLast(self, last: str):
-        self._setLast(last)
-        db.update('tasks', name=self.name, last=self._db_record.last)
+        self._db_record.last = self._lastValue(last)
+        self._db_record.next_due = self._nextDueValue(self._db_record.last)
+        db.update('tasks', name=self.name, last=self._db_record.last, next_due=self._db_record.next_due)
 
-    def _setLast(self, last: str):
-        self._db_record.last = last + ('<once>' if self.once else '')
+    def refreshNextDue(self):  # after schedule or lineage changes
+        next_due = self._nextDueValue(self._db_record.last)
 
-    @contextmanager
-    def notifyStateChangeContext(self):
-        state = self.state
+        if next_due != self._db_record.next_due:
+            self._db_record.next_due = next_due
+            db.update('tasks', name=self.name, next_due=next_due)
 
-        yield
+    def updateNextDue(self):  # of self and the descendants inheriting their schedule
+        tasks_lineage = lineage.current()
+        heirs = [name for name in tasks_lineage.descendants(self.name)
+                 if tasks_lineage.record(name).schedule == lineage.INHERIT]
+        self.refreshNextDue()
 
-        if self.pending and state == 'running':
-            self.notify('task {} succeeded'.format(self.name))
+        for name in heirs:
+            Task(record=schema.TableSchema(tasks_lineage.record(name))).refreshNextDue()
+
+    def _lastValue(self, last: str) -> str:
+        return last + ('<once>' if self.once else '')
+
+    def _transit(self, state: str, **kwargs) -> bool:  # compare-and-set from the state last read
+        was = self._db_record.state
+
+        if 'last' in kwargs:
+            kwargs.update(next_due=self._nextDueValue(kwargs['last']))
+
+        if not db.update_if('tasks', dict(state=was), name=self.name, state=state, **kwargs):
+            verbose(1, 'task', self.name, 'state changed by other, lost transition', was, '->', state)
+            self.reload()
+            return False
+
+        self._db_record.update(state=state, **kwargs)
+        self.notifyStateChange(was)
+        return True
+
+    def notifyStateChange(self, was: str):
+        if self.pending and was == 'running':
+            event, subject = 'succeeded', 'task {} succeeded'.format(self.name)
 
         else:
-            self.notify('task {} {} (was {})'.format(self.name, self.state, state)
-                        if self.state != state else '')
+            event = self.state
+            subject = 'task {} {} (was {})'.format(self.name, self.state, was) if self.state != was else ''
+
+        db.on_commit(lambda: self.notify(subject, event))
 
-    def notify(self, subject: str = ''):
+    def notify(self, subject: str = '', event: str = ''):
         if self.email:
             _subject = subject if subject else 'task {} {}'.format(self.name, self.state)
 
-            self.mailClient.send(
+            notifier.post(  # sent by the notifier thread, on a reused connection
                 recipients=self.email.split(','),
                 subject='autolite: ' + _subject,
                 content=yaml.dump(self.__dict__, default_flow_style=False),
+                task=self.name,
+                event=event,
+                digest=self.digestSecs,
+                log=self.log if event == 'failed' else '',  # excerpted by the notifier
             )
 
     def delete(self):
@@ -204,6 +238,11 @@ class Task(Entity):
         self._db_record = None
 
 
+@lru_cache(maxsize=None)
+def resource_set(resources: str) -> frozenset:  # parsed once per distinct resources value
+    return frozenset(resource for resource in (resources or '').split(' ') if resource)
+
+
 if __name__ == '__main__':
     db.init()
     for t, l in Task.walkIter(parent=''):
@@ -1,40 +1,209 @@
+import heapq
 import os
+import selectors
+import signal
 import subprocess
+import threading
+import time
+from datetime import datetime
+from time import sleep
 
 import db
+import logs
+import runs
+import shell_env
 from task import Task
 from verbosity import verbose
 
 LOG_ROOT = '/var/log/autolite'
+KILL_GRACE = 5.  # secs from SIGTERM to SIGKILL of a terminated task's process group
 
 
 g_procs = {}
+g_selector = selectors.DefaultSelector()  # wakes on child exit: per-proc pidfd, or SIGCHLD self-pipe
+g_sigchld_fd = None
+g_env_snapshot = False  # spawn with the shell env snapshot, instead of sourcing rc files per task
+g_default_timeout = 0.  # secs, for tasks without a timeout of their own
+g_deadlines = []  # heap of (monotonic deadline, pid, task name, signal), entries of completed procs skipped
+g_killing = set()  # pids of process groups terminated, yet to be killed after KILL_GRACE unless gone by then
+g_reaping = []  # [(task name, proc)], completed, yet recorded in runs only once reaped, e.g. terminated
 
 
-def start(task: Task):
+def start(task: Task) -> bool:  # claims the task, then spawns; False if lost to another runner
     global g_procs
 
-    g_procs.update({task.name: _new_proc(task)})
+    log_path = _new_log_path(task)
+
+    if not task.start(log_path):
+        return False
+
+    try:
+        g_procs.update({task.name: _new_proc(task, log_path)})
+
+    except Exception:
+        task.fail()
+        raise
+
+    _watch_exit(g_procs[task.name])
+    timeout = task.timeoutSecs or g_default_timeout
+
+    if timeout:
+        heapq.heappush(g_deadlines, (time.monotonic() + timeout, g_procs[task.name].pid, task.name, signal.SIGTERM))
+
     verbose(2, 'proc pool added with:', g_procs[task.name])
-    task.start(g_procs[task.name].stdout.name)
+    return True
 
 
 def terminate(task: Task):
     global g_procs
 
-    g_procs[task.name].terminate()
+    _kill_group(g_procs[task.name].pid, task.name, signal.SIGTERM)
     task.fail()
     verbose(1, 'task', task.name, 'terminated')
 
 
-def serve(timeout: int = 0) -> int:
+def serve() -> int:
     global g_procs
 
+    with db.transaction():
+        g_reaping.extend((task_name, g_procs.pop(task_name)) for task_name in _serve_procs())
+        reaped = [(task_name, proc) for task_name, proc in g_reaping if _reap(proc)]
+        g_reaping[:] = [entry for entry in g_reaping if entry not in reaped]
+        db.create_many('runs', [_run_record(task_name, proc) for task_name, proc in reaped])
+
+        if reaped:  # retention only changes with new runs
+            runs.compact(task_name for task_name, _ in reaped)
+
+    for _, proc in reaped:
+        _unwatch_exit(proc)
+        proc.stdout.close()
+
+    return len(g_procs)
+
+
+def lingering() -> int:  # terminated procs not reaped yet, or process groups still alive awaiting their SIGKILL
+    g_killing.difference_update([pid for pid in g_killing if not _group_alive(pid)])
+    return len(g_reaping) + len(g_killing)
+
+
+def seconds_to_deadline(default: float) -> float:  # until the next task timeout or kill escalation
+    _prune_deadlines()
+    return default if not g_deadlines else max(0., min(default, g_deadlines[0][0] - time.monotonic()))
+
+
+def wait(timeout: float) -> bool:  # block until a child exits or timeout, True if woken by exit
+    if not g_selector.get_map():
+        sleep(timeout)
+        return False
+
+    events = g_selector.select(max(timeout, 0))
+
+    for key, _ in events:
+        if key.fd == g_sigchld_fd:
+            _drain(g_sigchld_fd)
+
+    verbose(3, 'woken by' if events else 'waited', 'child exit' if events else timeout)
+    return bool(events)
+
+
+def _watch_exit(proc: subprocess.Popen):
+    if hasattr(os, 'pidfd_open'):
+        try:
+            proc.pidfd = os.pidfd_open(proc.pid)
+            g_selector.register(proc.pidfd, selectors.EVENT_READ)
+            return
+
+        except OSError as exc:  # kernel without pidfd
+            verbose(3, 'pidfd unsupported:', exc)
+
+    _watch_sigchld()
+
+
+def _unwatch_exit(proc: subprocess.Popen):
+    if hasattr(proc, 'pidfd'):
+        g_selector.unregister(proc.pidfd)
+        os.close(proc.pidfd)
+        del proc.pidfd
+
+
+def _watch_sigchld():
+    global g_sigchld_fd
+
+    if g_sigchld_fd is None and threading.current_thread() is threading.main_thread():
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+        signal.set_wakeup_fd(write_fd)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        g_selector.register(read_fd, selectors.EVENT_READ)
+        g_sigchld_fd = read_fd
+
+
+def _drain(fd: int):
+    try:
+        while os.read(fd, 512):
+            pass
+
+    except BlockingIOError:
+        pass
+
+
+def _kill_group(pid: int, task_name: str, sig: int):  # the task's shell and all its descendants
+    try:
+        os.killpg(pid, sig)
+
+    except ProcessLookupError:  # all exited
+        return
+
+    verbose(2, 'task', task_name, 'process group', pid, 'signaled', signal.Signals(sig).name)
+
+    if sig == signal.SIGTERM:
+        g_killing.add(pid)
+        heapq.heappush(g_deadlines, (time.monotonic() + KILL_GRACE, pid, task_name, signal.SIGKILL))
+
+
+def _pending(deadline: tuple) -> bool:  # a timeout of a running proc, or a kill escalation not gone yet
+    _, pid, task_name, sig = deadline
+
+    if sig == signal.SIGKILL:
+        return pid in g_killing
+
+    return task_name in g_procs and g_procs[task_name].pid == pid
+
+
+def _prune_deadlines():  # completed entries, lazily at the head, all at once if most are, bounding the heap
+    while g_deadlines and not _pending(g_deadlines[0]):
+        heapq.heappop(g_deadlines)
+
+    if len(g_deadlines) > 2 * (len(g_procs) + len(g_killing)):
+        g_deadlines[:] = [deadline for deadline in g_deadlines if _pending(deadline)]
+        heapq.heapify(g_deadlines)
+
+
+def _group_alive(pid: int) -> bool:
+    try:
+        os.killpg(pid, 0)
+        return True
+
+    except ProcessLookupError:
+        return False
+
+    except PermissionError:  # alive, yet not ours to signal
+        return True
+
+
+def _serve_procs() -> [str]:  # completed task names
     completed = []
+    records = db.read_many('tasks', g_procs.keys())  # one query for all, instead of per task
 
     for task_name, proc in g_procs.items():
-        task = Task(task_name)
-        task.reload()
+        if task_name not in records:
+            verbose(1, task_name, 'deleted')
+            _kill_group(proc.pid, task_name, signal.SIGTERM)
+            completed += [task_name]
+            continue
+
+        task = Task(record=records[task_name])
 
         if task.failed:
             verbose(1, task.name, 'aborted')
@@ -42,9 +211,7 @@ def serve(timeout: int = 0) -> int:
             completed += [task_name]
             continue
 
-        proc.poll()
-
-        if proc.returncode is not None:
+        if _reap(proc):
             if proc.returncode:
                 if proc.returncode == 126:  # bash error code for "Command invoked cannot execute"
                     task.skip()
@@ -65,42 +232,82 @@ def serve(timeout: int = 0) -> int:
 
             completed += [task_name]
 
-        elif timeout and task.expired(timeout):
-            _terminate_and_fail(task, timeout)
+    now = time.monotonic()
+
+    while g_deadlines and g_deadlines[0][0] <= now:
+        _, pid, task_name, sig = heapq.heappop(g_deadlines)
+
+        if sig == signal.SIGKILL and pid in g_killing:  # regardless of the shell, its descendants may linger
+            g_killing.discard(pid)
+            _kill_group(pid, task_name, sig)
+
+        elif task_name in g_procs and g_procs[task_name].pid == pid and task_name not in completed:
+            g_procs[task_name].timed_out = True
+            _terminate_and_fail(Task(record=records[task_name]))
             completed += [task_name]
 
-    for task in completed:
-        g_procs[task].stdout.close()
-        del g_procs[task]
+    return completed
 
-    return len(g_procs)
 
+def _reap(proc: subprocess.Popen) -> bool:  # True once exited, with returncode & rusage, without blocking
+    if proc.returncode is None:
+        try:
+            pid, status, proc.rusage = os.wait4(proc.pid, os.WNOHANG)
+
+        except ChildProcessError:  # reaped elsewhere, no rusage
+            return proc.poll() is not None
+
+        if pid:
+            proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+    return proc.returncode is not None
+
+
+def _run_record(task_name: str, proc: subprocess.Popen) -> dict:
+    end = datetime.now()
+    usage = getattr(proc, 'rusage', None)  # of the reaped shell & its waited for descendants
+
+    return dict(
+        name=task_name,
+        start=str(proc.started),
+        end=str(end),
+        duration=(end - proc.started).total_seconds(),
+        returncode=proc.returncode,
+        timed_out=int(getattr(proc, 'timed_out', False)),
+        log=proc.stdout.name,
+        log_start=proc.log_start,
+        log_end=os.fstat(proc.stdout.fileno()).st_size,
+        cpu_user=usage.ru_utime if usage else 0,
+        cpu_sys=usage.ru_stime if usage else 0,
+        max_rss=usage.ru_maxrss if usage else 0,
+    )
+
+
+def _new_proc(task: Task, log_path: str) -> subprocess.Popen:
+    logfile = open(log_path, 'a+', 1)
+    started, log_start = datetime.now(), os.fstat(logfile.fileno()).st_size
+
+    if g_env_snapshot:  # rc files sourced once, not per task
+        result = subprocess.Popen(task.command, env=dict(shell_env.snapshot(), AUTOLITE_TASK_NAME=task.name),
+                                  shell=True, universal_newlines=True, stdout=logfile, stderr=logfile,
+                                  start_new_session=True)
+
+    else:
+        script = shell_env.SOURCE_RC + 'export AUTOLITE_TASK_NAME="{}"\n'.format(task.name) + task.command
+        result = subprocess.Popen(script, shell=True, universal_newlines=True, stdout=logfile, stderr=logfile,
+                                  start_new_session=True)  # a process group to kill as a whole
 
-def _new_proc(task: Task) -> subprocess.Popen:
-    logfile = open(_new_log_path(task), 'a+', 1)
-    result = subprocess.Popen('''
-if [ -e ~/.bashrc ]
-then
-    . ~/.bashrc
-elif [ -e ~/.bash_profile ]
-then
-    . ~/.bash_profile
-fi
-export AUTOLITE_TASK_NAME="{}"
-'''.format(task.name) + task.command,
-        shell=True, universal_newlines=True, stdout=logfile, stderr=logfile)
     result.stdout = logfile
+    result.started, result.log_start = started, log_start
     return result
 
 
-def _new_log_path(task: Task) -> str:
-    log_path = os.path.join(LOG_ROOT, db.name())
-    os.makedirs(log_path, exist_ok=True)
-    return '{path}/{task_name}.log'.format(path=log_path, task_name=task.name)
+def _new_log_path(task: Task) -> str:  # runs are appended to a segment, indexed by offsets in the runs table
+    return logs.segment(os.path.join(LOG_ROOT, db.name(), task.name))
 
 
-def _terminate_and_fail(task: Task, timeout: int):
-    verbose(0, 'task', task.name, 'timed-out after', timeout, 'sec, terminating...')
-    g_procs[task.name].terminate()
+def _terminate_and_fail(task: Task):
+    verbose(0, 'task', task.name, 'timed-out after', task.timeoutSecs or g_default_timeout, 'sec, terminating...')
+    _kill_group(g_procs[task.name].pid, task.name, signal.SIGTERM)
     verbose(2, 'proc terminated, task:', task.name)
     task.fail()
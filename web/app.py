@@ -1,6 +1,6 @@
 #!flask/bin/python
 
-from flask import Flask, jsonify
+from flask import Flask, Response, abort, jsonify, request, stream_with_context
 
 from web import server
 
@@ -40,6 +40,18 @@ def get_tasks(name: str = '') -> str:
     return jsonify(server.get_tasks(name))
 
 
+@app.route('/api/v1/tasks/<string:name>/log', methods=['GET'])
+def follow_task_log(name: str) -> Response:  # Server-Sent Events, resumed by EventSource from its Last-Event-ID
+    try:
+        events = server.sse_task_log(name, request.headers.get('Last-Event-ID', request.args.get('offset')))
+
+    except NameError:
+        abort(404)
+
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/api/v1/systems', methods=['GET'])
 @app.route('/api/v1/systems/<string:name>', methods=['GET'])
 def get_systems(name: str = '') -> str:
@@ -1,5 +1,13 @@
-import json
-import subprocess
+import codecs
+import re
+import sys
+import time
+
+import db
+import logs
+from entity import MetaEntity
+from system import System
+from task import Task
 
 g_root_url = '/'
 
@@ -51,6 +59,15 @@ TR = '<tr class="{cls}" {onclick}>{cells}</tr>'
 TD = '<td nowrap style="vertical-align:top; padding:5px; {style}">{val}</td>'
 A = '<a href="{val}">{val}</a>'
 
+LOG_FOLLOW = '''
+<pre id="log" style="text-align: left; margin: 20px"></pre>
+<script type="text/javascript">
+var source = new EventSource("{url}");
+source.onmessage = function(event) {{ document.getElementById("log").textContent += event.data; }};
+source.addEventListener("end", function() {{ source.close(); }});
+</script>
+'''
+
 
 def html_table(data: [dict] = None, columns: [str] = None, click_url: str = '/') -> str:
     return TABLE.format(
@@ -98,7 +115,7 @@ def index() -> str:
 
 
 def html_tasks() -> str:
-    data = json.loads(subprocess.getoutput('autolite task list -J'))
+    data = _list_dicts(Task)
     columns = 'name parent schedule state resources last'.split(' ')
     return HTML_HEAD + '''
 <p><b>Tasks</b> | <a href="{root}systems">Systems</a></p>
@@ -108,18 +125,19 @@ def html_tasks() -> str:
 
 
 def html_task(name: str = '') -> str:
-    tasks = json.loads(subprocess.getoutput('autolite task list {} -J'.format(name)))
+    tasks = _list_dicts(Task, name)
     task = tasks[0] if tasks else dict()
     fields = 'name parent schedule state condition command resources log email last'.split(' ')
     return HTML_HEAD + '''
 <p><a href="{root}tasks">Tasks</a> | <a href="{root}systems">Systems</a></p>
 '''.format(root=g_root_url) + \
         html_record(task, fields, head=False) + \
+        (LOG_FOLLOW.format(url='{}api/v1/tasks/{}/log'.format(g_root_url, name)) if task.get('log') else '') + \
         HTML_TAIL
 
 
 def html_systems() -> str:
-    data = json.loads(subprocess.getoutput('autolite system list -J'))
+    data = _list_dicts(System)
     columns = 'name user comment'.split(' ')
     return HTML_HEAD + '''
 <p><a href="{root}tasks">Tasks</a> | <b>Systems</b></p>
@@ -129,7 +147,7 @@ def html_systems() -> str:
 
 
 def html_system(name: str = '') -> str:
-    systems = json.loads(subprocess.getoutput('autolite system list {} -J'.format(name)))
+    systems = _list_dicts(System, name)
     system = systems[0] if systems else dict()
     fields = 'name ip user comment installer cleaner monitor config'.split(' ')
     return HTML_HEAD + '''
@@ -143,10 +161,83 @@ def html_system(name: str = '') -> str:
 
 
 def get_tasks(name: str = '') -> dict:
-    data = json.loads(subprocess.getoutput('autolite task list {} -J'.format(name)))
+    data = _list_dicts(Task, name)
     return data[0] if len(data) == 1 else data
 
 
 def get_systems(name: str = '') -> dict:
-    data = json.loads(subprocess.getoutput('autolite system list {} -J'.format(name)))
+    data = _list_dicts(System, name)
     return data[0] if len(data) == 1 else data
+
+
+# Log streaming, as Server-Sent Events
+
+
+def sse_task_log(name: str, offset: str = None) -> iter:  # running or latest run output, event ids resume offsets
+    if db.connection() is None:
+        db.init()
+
+    return _sse_log_events(Task(name), offset)  # raises NameError of a missing task, before streaming
+
+
+def _sse_log_events(task: Task, offset: str = None) -> iter:
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')  # chars split across chunks
+    reloaded = [0.]  # time.monotonic() of the last Db read
+
+    def done() -> bool:  # reading the Db at most every FOLLOW_CHECK, not per write woken by
+        if time.monotonic() - reloaded[0] >= logs.FOLLOW_CHECK:
+            reloaded[0] = time.monotonic()
+            task.reload()
+
+        return not task.running
+
+    yield ': following {}\n\n'.format(task.name)  # a comment, sending the response headers now
+
+    if task.log:
+        log_offset = _run_log_start(task) if offset is None else int(offset)
+
+        for chunk in _log_chunks(task.log, log_offset, done):
+            log_offset += len(chunk)
+            text = decoder.decode(chunk)
+
+            if text:  # each line a data field, rejoined by the browser
+                lines = re.split('\r\n|\r|\n', text)
+                yield 'id: {}\n{}\n'.format(log_offset - len(decoder.getstate()[0]),
+                                             ''.join('data: {}\n'.format(line) for line in lines))
+
+    yield 'event: end\ndata: \n\n'
+
+
+def _log_chunks(log_path: str, offset: int, done) -> iter:  # followed, or of the compressed segment, if rotated since
+    try:
+        for chunk in logs.follow(log_path, offset, done):
+            yield chunk
+
+    except FileNotFoundError:  # raised opening, before any chunk
+        try:
+            for chunk in logs.read(log_path, offset, sys.maxsize):
+                yield chunk
+
+        except FileNotFoundError:  # rotated out
+            pass
+
+
+def _run_log_start(task: Task) -> int:  # offset of the running, or latest, run in the task's log segment
+    in_segment = [run for run in db.list_table('runs', name=task.name) if run.log == task.log]
+
+    if not in_segment:
+        return 0
+
+    latest = max(in_segment, key=lambda run: run.start)
+    return int(latest.log_end if task.running else latest.log_start)
+
+
+# Data access, in-process over the calling thread's Db connection
+
+
+def _list_dicts(entity: MetaEntity, name: str = '') -> [dict]:
+    if db.connection() is None:
+        db.init()
+
+    where = dict(name=name) if name else dict()
+    return [item.__dict__ for item in entity.list(**where)]